@@ -14,6 +14,85 @@
 
 import sys
 import argparse
+import bisect
+import threading
+import re
+import mmap
+import multiprocessing
+import itertools
+import hashlib
+import marshal
+import struct
+import os
+import time
+import json
+import stat
+import socket
+import signal
+import errno
+import collections
+import io
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# Python 2 and 3
+#
+# The interpreter runs unchanged on Python 2.7, Python 3 and PyPy.  Program files
+# are read as bytes and each line is decoded for the tokenizer by textline(), so
+# that bytes that are not ASCII never form tokens or split lines, just as with
+# Python 2 strings.  Output is buffered as text and encoded by encodeoutput() when
+# it is written to the underlying binary stream: Unicode characters in UTF-8 and
+# everything else byte for byte.  A text stream without a binary stream, such as
+# io.StringIO, is given the text that decodeoutput() makes of those bytes.
+if sys.version_info[0] >= 3:
+    xrange = range
+    INTEGER_TYPES = (int,)
+    STRING_TYPES = (str, bytes)
+    
+    def textline(line):
+        if isinstance(line, bytes):
+            return line.decode('ascii', 'surrogateescape')
+        return line
+    
+    def unicodechar(value):
+        return chr(value)
+    
+    def encodeoutput(text, encoding):
+        return text.encode(encoding, 'surrogatepass')
+    
+    def decodeoutput(data, encoding):
+        return data.decode(encoding, 'surrogatepass')
+else:
+    INTEGER_TYPES = (int, long)
+    STRING_TYPES = (basestring,)
+    
+    def textline(line):
+        return line
+    
+    def unicodechar(value):
+        return unichr(value).encode('utf-8')
+    
+    def encodeoutput(text, encoding):
+        return text
+    
+    def decodeoutput(data, encoding):
+        return data.decode(encoding)
+
+# Returns the binary stream underneath stream, which is stream itself if it is
+# not a Python 3 text stream.
+def bytestream(stream):
+    return getattr(stream, 'buffer', stream)
+
+# Returns true if stream is a text stream with no binary stream underneath, which
+# can only be written text.
+def textonly(stream):
+    return isinstance(stream, io.TextIOBase) and not hasattr(stream, 'buffer')
 
 def printerr(message, line, linenum):
     sys.stderr.write("Error: " + message + " on line " + linenum + ":\n")
@@ -28,6 +107,9 @@ def parsererr(message, stepnum, tokens, tokidx):
 def warning(message):
     sys.stderr.write("Warning: " + message + '\n')
 
+def note(message):
+    sys.stderr.write("Note: " + message + '\n')
+
 # Token constants
 DOT = '.'
 PLUS = '+'
@@ -43,72 +125,83 @@ CHAR = 'Character'
 
 TEXT_TOKENS = [N, STEP, STOP, GO, TO, SWAP, WITH, OUTPUT, CHAR]
 
+# Keywords and symbols by their normalized capitalization.  The common
+# lowercase and uppercase spellings are included to avoid calling title().
+KEYWORDS = {DOT: DOT, PLUS: PLUS}
+for tok in TEXT_TOKENS:
+    KEYWORDS[tok] = KEYWORDS[tok.lower()] = KEYWORDS[tok.upper()] = tok
+
+# Splits a line at whitespace and special characters.  Only ASCII characters
+# count as whitespace, as in Python 2.
+TOKEN_RE = re.compile(r"[^\s#.+nN]+|[.+nN]|#", getattr(re, 'ASCII', 0))
+
+# Raised by tokenlines() after reporting an error
+class TokenError(Exception):
+    pass
+
 # Tokenize one line of the program listing.
 # Returns a (possibly empty) list of tokens or False if an error occurs
 def tokenize(line, linenum):
-    tokens = []
-    curtok = ""
-    # split line at whitespace and special characters
-    for c in line:
-        if c.isspace():
-            if curtok == "":
-                # discard extra whitespace and continue
-                continue
-            else:
-                # end of current token
-                tokens.append(curtok)
-                curtok = ""
-        elif c == '#':
-            if tokens == [] and curtok == "":
-                # comment line: ignore the rest of the line
-                return tokens
-            else:
-                printerr("Comment started after non-whitespace character", line, str(linenum))
-                return False
-        elif c == '.' or c == '+' or c == 'n' or c == 'N':
-            if curtok != "":
-                # end of current token
-                tokens.append(curtok)
-            tokens.append(c)
-            curtok = ""
+    words = TOKEN_RE.findall(line)
+    if '#' in words:
+        if words[0] == '#':
+            # comment line: ignore the rest of the line
+            return []
         else:
-            # add to current token
-            curtok += c
-    if curtok != "":
-        tokens.append(curtok)
-
+            printerr("Comment started after non-whitespace character", line, str(linenum))
+            return False
+    
     # identify keywords and numbers
-    for i in xrange(len(tokens)):
-        if tokens[i].isdigit():
-            # convert number string to an integer
-            tokens[i] = int(tokens[i])
-        elif tokens[i] == DOT or tokens[i] == PLUS:
-            continue
-        else:
-            matched = False
-            # normalize the capitalization of keywords
-            tok = tokens[i].title()
-            for validtok in TEXT_TOKENS:
-                if tok == validtok:
-                    tokens[i] = validtok
-                    matched = True
-                    break
-            if not matched:
-                # TODO? The specification says that
-                # "Whitespace is allowed before and after tokens".
-                # Do we need to allow for the possibility that
-                # there may not be any whitespace between keywords
-                # or keywords & numbers. (Eg. "Gotostep", "Step10")
-                printerr("Ilegal token '" + tokens[i] + "'", line, str(linenum))
-                return False
+    tokens = []
+    for word in words:
+        tok = KEYWORDS.get(word)
+        if tok is None:
+            if word.isdigit():
+                # convert number string to an integer
+                tok = int(word)
+            else:
+                # normalize the capitalization of keywords
+                tok = KEYWORDS.get(word.title())
+                if tok is None:
+                    # TODO? The specification says that
+                    # "Whitespace is allowed before and after tokens".
+                    # Do we need to allow for the possibility that
+                    # there may not be any whitespace between keywords
+                    # or keywords & numbers. (Eg. "Gotostep", "Step10")
+                    printerr("Ilegal token '" + word + "'", line, str(linenum))
+                    return False
+        tokens.append(tok)
     
     return tokens
 
+# Reads a program file (or any other iterable of lines) and yields the tokens of
+# each line as a list.  A file is memory-mapped when possible.  Raises TokenError
+# if a line has an error.
+def tokenlines(f):
+    try:
+        lines = iter(mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ).readline, b"")
+    except (AttributeError, EnvironmentError, ValueError):
+        # lists of lines, empty files and pipes cannot be mapped
+        lines = f
+    linenum = 1
+    for line in lines:
+        tokens = tokenize(textline(line), linenum)
+        if not tokens and type(tokens) is bool:
+            raise TokenError()
+        # The spec does not restrict where newlines can appear so we allow
+        # steps to cross line boundaries and multiple steps per line.
+        # (This contrasts with the SMETANA grammar which requires a newline
+        #  after each step).
+        yield tokens
+        linenum += 1
+
 # Program data structure
 #
-# A program is a tuple (numbered steps, expression steps) where the numbered steps
-# are stored in a dictionary and the expression steps in a list.  Each numbered
-# step is an entry in the dictionary of the form
+# A program is a tuple (numbered steps, expression steps, expression index, numbered
+# index) where the numbered steps are stored in a dictionary and the expression
+# steps in a list.  The expression index is derived from the expression steps (see
+# buildexprindex()) and the numbered index is the sorted list of numbered step#s.
+# Each numbered step is an entry in the dictionary of the form
 #           step# -> (instruction code, arg1, arg2)
 #
 # A STOP instruction takes no arguments:    (iSTOP, None, None)
@@ -116,13 +209,25 @@ def tokenize(line, linenum):
 # A SWAP instruction takes two arguments:   (iSWAP, step#, step#)
 # An OUTPUT instruction takes one argument: (iOUTP, number, None)
 #
+# All STOP instructions share the single tuple STOPINSTR.
+#
 # Steps with expressions are stored in a list in the reverse order that they appear
-# in the program listing.  Each "n"-expression, an + b, is stored as a tuple (a, b).
-# An expression step is a pair with the structure
-#           ( (a,b), (instruction code, arg1, arg2) )
-# If an argument is a number then it is just an integer element of the inner tuple.
-# If an argument is an expression then it is a pair (a,b) as above.  Otherwise an
-# argument is 'None'.
+# in the program listing.  Each "n"-expression, an + b, is written as a pair (a, b)
+# by the parser, but an expression step is stored as one flat tuple
+#           (a, b, instruction code, a1, b1, a2, b2)
+# where the step matches an + b and the arguments are a1*n + b1 and a2*n + b2.
+# Whether an argument is a number or an expression is decided once by the parser:
+# a number c is stored as 0*n + c.  Missing arguments are stored as None, None.
+#
+# The expression index groups the expression steps by their multiplier a so that
+# findexprstep() only needs one probe per distinct multiplier instead of one
+# test per expression step.  It is a list of triples
+#           (a, residue classes, best precedence)
+# where residue classes is a dictionary mapping b % a to a list of
+#           (precedence, b, expression step)
+# sorted by precedence.  Precedence is the position of the expression step in the
+# (reversed) expression step list, so smaller values win.  The groups themselves
+# are sorted by the best precedence that they contain.
 
 # Instruction codes
 iSTOP = 0
@@ -135,41 +240,48 @@ iOUTP = 3
 # for program
 NUMDSTEPS = 0
 EXPRSTEPS = 1
+EXPRINDEX = 2
+NUMDINDEX = 3
 
 # for "n-"expression steps
-NEXPR = 0
-NINSTR = 1
+STEPA = 0
+STEPB = 1
+STEPCODE = 2
+STEPARGS = 3
 
 # for instructions
 ICODE = 0
 ARG1 = 1
 ARG2 = 2
 
+STOPINSTR = (iSTOP, None, None)
+
 # Parse an expression which can be just a number or an "n"-expression.
 # Returns a pair (result, new idx) where result is an integer, a pair (a,b)
 # representing an "n"-expression, or False if an error occurred.  New idx is the
-# index of the next token in tokens after the parsed expression.
-def parse_expr(tokens, idx, curstep, stepidx):
+# index of the next token in tokens after the parsed expression.  Errors are
+# reported by calling error, which takes the same arguments as parsererr().
+def parse_expr(tokens, idx, curstep, stepidx, error = parsererr):
     leadingnum = None
     haveN = False
     addend = None
-    if type(tokens[idx]) is int:
+    if type(tokens[idx]) in INTEGER_TYPES:
         leadingnum = tokens[idx]
         idx += 1
     if tokens[idx] == N:
         haveN = True
         idx += 1
         if tokens[idx] == PLUS:
-            if type(tokens[idx+1]) is int:
+            if type(tokens[idx+1]) in INTEGER_TYPES:
                 addend = tokens[idx+1]
                 idx +=2
             else:
-                parsererr("Illegal expression - expected a number after '+'", curstep, tokens, stepidx)
+                error("Illegal expression - expected a number after '+'", curstep, tokens, stepidx)
                 return (False, idx)
         else:
             addend = 0
     elif leadingnum == None:
-        parsererr("Illegal expression - expected a number or 'n'", curstep, tokens, stepidx)
+        error("Illegal expression - expected a number or 'n'", curstep, tokens, stepidx)
         return (False, idx)
 
     # have a valid expression, so return the result
@@ -181,137 +293,403 @@ def parse_expr(tokens, idx, curstep, stepidx):
 
 # parse() checks the syntax of the list of tokens and converts them to a "program"
 # data structure for the interpreter.  Returns the program or False if an error occurs.
-def parse(tokens):
+# If more is given, it is an iterator over further lists of tokens (such as
+# tokenlines()) that are read as they are needed.  If messages is a list, the
+# warnings about the program are also added to it.
+PARSE_LOOKAHEAD = 64    # more than the tokens in any step plus error context
+PARSE_WINDOW = 4096
+
+def parse(tokens, more = None, messages = None):
+    if more is not None:
+        tokens = list(tokens)
     numberedsteps = {}
     exprsteps = []
+    # For each step number, the number of expression steps that preceded its last
+    # definition, and the same for the earlier definitions of redefined steps.
+    # Used to find the numbered steps replaced by expressions.
+    lastdefs = {}
+    earlierdefs = []
     curstep = 0
     curinstr = None
+    
+    # Reports a parse error like parsererr(), but first warns about the steps
+    # replaced so far, which would be lost otherwise.
+    def error(message, stepnum, tokens, tokidx):
+        parsedsteps = exprsteps[::-1]
+        removereplaced(dict(numberedsteps), lastdefs, earlierdefs, parsedsteps,
+                       buildexprindex(parsedsteps), messages)
+        parsererr(message, stepnum, tokens, tokidx)
+    
     idx = 0
     endidx = len(tokens)
-    while idx < endidx:
+    while True:
+        if more is not None and endidx - idx < PARSE_LOOKAHEAD:
+            # drop the tokens already parsed and read more
+            del tokens[:idx]
+            idx = 0
+            for linetokens in more:
+                tokens += linetokens
+                if len(tokens) >= PARSE_WINDOW:
+                    break
+            else:
+                more = None
+            endidx = len(tokens)
+        if idx >= endidx:
+            break
         try:
             # beginning of a step definition
             stepidx = idx
             if tokens[idx] == STEP:
                 idx += 1
                 # parse step number/expression
-                (expr,idx) = parse_expr(tokens, idx, curstep, stepidx)
+                (expr,idx) = parse_expr(tokens, idx, curstep, stepidx, error)
                 if type(expr) is bool and not expr:  return False
-                if type(expr) is int and expr == 0:
-                    parsererr("0 is not a valid step number", 0, tokens, stepidx)
+                if type(expr) in INTEGER_TYPES and expr == 0:
+                    error("0 is not a valid step number", 0, tokens, stepidx)
+                    return False
+                if isNexpr(expr) and expr[0] == 0:
+                    error("0n is not a valid step expression", expr, tokens, stepidx)
                     return False
                 curstep = expr
                 if tokens[idx] != DOT:
-                    parsererr("Missing '.' after the step number", curstep, tokens, stepidx)
+                    error("Missing '.' after the step number", curstep, tokens, stepidx)
                     return False
                 idx += 1
             else:
-                parsererr("Missing 'Step' at the beginning of a step definition", curstep, tokens, stepidx)
+                error("Missing 'Step' at the beginning of a step definition", curstep, tokens, stepidx)
                 return False
             
             # parse step instruction
             # STOP instruction
             if tokens[idx] == STOP:
                 idx += 1
-                curinstr = (iSTOP, None, None)
+                curinstr = STOPINSTR
             
             # GO TO instruction
             elif tokens[idx] == GO:
                 if tokens[idx+1] != TO:
-                    parsererr("Missing 'To' after 'Go'", curstep, tokens, stepidx)
+                    error("Missing 'To' after 'Go'", curstep, tokens, stepidx)
                     return False
                 if tokens[idx+2] != STEP:
-                    parsererr("Missing 'Step' after 'Go To'", curstep, tokens, stepidx)
+                    error("Missing 'Step' after 'Go To'", curstep, tokens, stepidx)
                     return False
                 idx += 3
                 # parse target step number/expression
-                (expr,idx) = parse_expr(tokens, idx, curstep, stepidx)
+                (expr,idx) = parse_expr(tokens, idx, curstep, stepidx, error)
                 if type(expr) is bool and not expr:  return False
-                if type(expr) is int and expr == 0:
-                    parsererr("0 is not a valid target step number", curstep, tokens, stepidx)
+                if type(expr) in INTEGER_TYPES and expr == 0:
+                    error("0 is not a valid target step number", curstep, tokens, stepidx)
                     return False
-                if type(curstep) is int and not type(expr) is int:
-                    parsererr("Illegal 'n'-expression in a numbered step", curstep, tokens, stepidx)
+                if type(curstep) in INTEGER_TYPES and type(expr) not in INTEGER_TYPES:
+                    error("Illegal 'n'-expression in a numbered step", curstep, tokens, stepidx)
                     return False
                 curinstr = (iGOTO, expr, None)
             
             # SWAP instruction
             elif tokens[idx] == SWAP:
                 if tokens[idx+1] != STEP:
-                    parsererr("Missing 'Step' after 'Swap'", curstep, tokens, stepidx)
+                    error("Missing 'Step' after 'Swap'", curstep, tokens, stepidx)
                     return False
                 idx += 2
                 # parse first target step number/expression
-                (arg1,idx) = parse_expr(tokens, idx, curstep, stepidx)
+                (arg1,idx) = parse_expr(tokens, idx, curstep, stepidx, error)
                 if type(arg1) is bool and not arg1:  return False
-                if type(arg1) is int and arg1 == 0:
-                    parsererr("0 is not a valid target step number", curstep, tokens, stepidx)
+                if type(arg1) in INTEGER_TYPES and arg1 == 0:
+                    error("0 is not a valid target step number", curstep, tokens, stepidx)
                     return False
-                if type(curstep) is int and not type(arg1) is int:
-                    parsererr("Illegal 'n'-expression in a numbered step", curstep, tokens, stepidx)
+                if type(curstep) in INTEGER_TYPES and type(arg1) not in INTEGER_TYPES:
+                    error("Illegal 'n'-expression in a numbered step", curstep, tokens, stepidx)
                     return False
                 # check for "with step"
                 if tokens[idx] != WITH:
-                    parsererr("Missing 'With' after first swap target", curstep, tokens, stepidx)
+                    error("Missing 'With' after first swap target", curstep, tokens, stepidx)
                     return False
                 if tokens[idx+1] != STEP:
-                    parsererr("Missing 'Step' after 'With'", curstep, tokens, stepidx)
+                    error("Missing 'Step' after 'With'", curstep, tokens, stepidx)
                     return False
                 idx += 2
                 # parse second target step number/expression
-                (arg2,idx) = parse_expr(tokens, idx, curstep, stepidx)
+                (arg2,idx) = parse_expr(tokens, idx, curstep, stepidx, error)
                 if type(arg2) is bool and not arg2:  return False
-                if type(arg2) is int and arg2 == 0:
-                    parsererr("0 is not a valid target step number", curstep, tokens, stepidx)
+                if type(arg2) in INTEGER_TYPES and arg2 == 0:
+                    error("0 is not a valid target step number", curstep, tokens, stepidx)
                     return False
-                if type(curstep) is int and not type(arg2) is int:
-                    parsererr("Illegal 'n'-expression in a numbered step", curstep, tokens, stepidx)
+                if type(curstep) in INTEGER_TYPES and type(arg2) not in INTEGER_TYPES:
+                    error("Illegal 'n'-expression in a numbered step", curstep, tokens, stepidx)
                     return False
                 curinstr = (iSWAP, arg1, arg2)
             
             # OUTPUT instruction
             elif tokens[idx] == OUTPUT:
                 if tokens[idx+1] != CHAR:
-                    parsererr("Missing 'Character' after 'Output'", curstep, tokens, stepidx)
+                    error("Missing 'Character' after 'Output'", curstep, tokens, stepidx)
                     return False
                 idx += 2
                 # parse number/expression to output
-                (expr,idx) = parse_expr(tokens, idx, curstep, stepidx)
+                (expr,idx) = parse_expr(tokens, idx, curstep, stepidx, error)
                 if type(expr) is bool and not expr:  return False
-                if type(curstep) is int and not type(expr) is int:
-                    parsererr("Illegal 'n'-expression in a numbered step", curstep, tokens, stepidx)
+                if type(curstep) in INTEGER_TYPES and type(expr) not in INTEGER_TYPES:
+                    error("Illegal 'n'-expression in a numbered step", curstep, tokens, stepidx)
                     return False
                 curinstr = (iOUTP, expr, None)
             
             else:
-                parsererr("Illegal instruction '" + str(tokens[idx]) + "'", curstep, tokens, stepidx)
+                error("Illegal instruction '" + str(tokens[idx]) + "'", curstep, tokens, stepidx)
                 return False
             
             # check for end of step
             if tokens[idx] != DOT:
-                parsererr("Missing '.' at end of instruction", curstep, tokens, stepidx)
+                error("Missing '.' at end of instruction", curstep, tokens, stepidx)
                 return False
             idx += 1
             # add step to program
-            if type(curstep) is int:
+            if type(curstep) in INTEGER_TYPES:
                 numberedsteps[curstep] = curinstr
+                if curstep in lastdefs:
+                    earlierdefs.append( (curstep, lastdefs[curstep]) )
+                lastdefs[curstep] = len(exprsteps)
             else:
-                exprsteps.append( (curstep, curinstr) )
-                # If this expression can match any previously defined steps, remove them.
-                # (We could remove matching expression steps too, but leaving them does
-                # not affect the correct execution of the program).
-                for stepnum in numberedsteps.keys():
-                    if matchNexpression(stepnum, curstep):
-                        del numberedsteps[stepnum]
-                        warning("Step " + nexpr2str(curstep) + " has replaced step " + str(stepnum))
+                exprsteps.append(compilestep(curstep, curinstr))
         except IndexError:
-            parsererr("Unexpected end of program OR internal parser error", curstep, tokens, stepidx)
+            error("Unexpected end of program OR internal parser error", curstep, tokens, stepidx)
             return False
     
     # reverse the order of the steps with expressions so that the last matching expression has precedence 
     exprsteps.reverse()
+    exprindex = buildexprindex(exprsteps)
+    
+    # If an expression can match any previously defined numbered steps, remove them.
+    # (We could remove matching expression steps too, but leaving them does
+    # not affect the correct execution of the program).
+    removereplaced(numberedsteps, lastdefs, earlierdefs, exprsteps, exprindex, messages)
+    
+    return (numberedsteps, exprsteps, exprindex, sorted(numberedsteps))
+
+# Converts an "n"-expression step and its parsed instruction into the flat tuple
+# (a, b, instruction code, a1, b1, a2, b2) stored in the program.
+def compilestep(nexpr, instr):
+    step = [nexpr[0], nexpr[1], instr[ICODE]]
+    for arg in instr[ARG1:]:
+        if arg is None:
+            step += [None, None]
+        elif isNexpr(arg):
+            step += arg
+        else:
+            step += [0, arg]
+    return tuple(step)
+
+# Builds the expression index for a list of expression steps that is already in
+# precedence order.  Returns a list of (a, residue classes, best precedence).
+def buildexprindex(exprsteps):
+    groups = {}
+    for prec in xrange(len(exprsteps)):
+        step = exprsteps[prec]
+        (a, b) = step[STEPA:STEPCODE]
+        classes = groups.setdefault(a, {})
+        # steps are visited in precedence order so each class list stays sorted
+        classes.setdefault(b % a, []).append( (prec, b, step) )
+    
+    index = []
+    for (a, classes) in groups.items():
+        bestprec = min(rules[0][0] for rules in classes.values())
+        index.append( (a, classes, bestprec) )
+    index.sort(key = lambda group: group[2])
+    return index
+
+# Removes the numbered steps that are replaced by expression steps appearing after
+# them in the program listing from the dictionary numberedsteps and warns about
+# each replacement, also adding the warnings to the list messages if it is given.
+# The other arguments are those of findreplaced().
+def removereplaced(numberedsteps, lastdefs, earlierdefs, exprsteps, exprindex, messages = None):
+    for (exprnum, stepnum) in findreplaced(lastdefs, earlierdefs, exprsteps, exprindex):
+        if exprnum >= lastdefs[stepnum]:
+            # replaced after its last definition
+            del numberedsteps[stepnum]
+        nexpr = exprsteps[len(exprsteps) - 1 - exprnum][STEPA:STEPCODE]
+        message = "Step " + nexpr2str(nexpr) + " has replaced step " + str(stepnum)
+        warning(message)
+        if messages is not None:
+            messages.append(message)
+
+# Finds the numbered steps that are replaced by expression steps appearing after
+# them in the program listing.  lastdefs maps each step number to the number of
+# expression steps preceding its last definition and earlierdefs lists the same
+# for earlier definitions as (step number, count) pairs.  Each definition is replaced
+# by the first matching expression that follows it, unless the step number is
+# defined again before that.  Returns a sorted list of (expression position, step
+# number) pairs, one for each replacement, where the expression position counts
+# the expression steps in listing order.
+def findreplaced(lastdefs, earlierdefs, exprsteps, exprindex):
+    if not lastdefs or not exprsteps:
+        return []
+    # all definitions of each redefined step in listing order
+    numbereddefs = {}
+    for (stepnum, count) in earlierdefs:
+        numbereddefs.setdefault(stepnum, []).append(count)
+    for stepnum in numbereddefs:
+        numbereddefs[stepnum].append(lastdefs[stepnum])
+    
+    lastprec = len(exprsteps) - 1
+    maxstep = max(lastdefs)
+    # listing positions of the expressions following a definition that match each step
+    matching = {}
+    for (a, classes, bestprec) in exprindex:
+        nrules = sum(len(rules) for rules in classes.values())
+        if maxstep <= sys.maxsize and nrules * (maxstep // a) <= len(lastdefs):
+            # a is large: enumerate the few step numbers that each expression matches
+            for rules in classes.values():
+                for (prec, b, step) in rules:
+                    for stepnum in xrange(a + b, maxstep + 1, a):
+                        if stepnum in lastdefs:
+                            matching.setdefault(stepnum, []).append(lastprec - prec)
+        else:
+            # a is small: look up the residue class of each numbered step instead
+            for (stepnum, lastdef) in lastdefs.items():
+                rules = classes.get(stepnum % a)
+                if not rules:
+                    continue
+                for d in numbereddefs.get(stepnum, (lastdef,)):
+                    # (lastprec - d + 1,) sorts before every rule listed before definition d
+                    i = bisect.bisect_left(rules, (lastprec - d + 1,))
+                    while i > 0:
+                        i -= 1
+                        (prec, b, step) = rules[i]
+                        if stepnum > b:
+                            matching.setdefault(stepnum, []).append(lastprec - prec)
+                            break
+    
+    replaced = []
+    for (stepnum, positions) in matching.items():
+        positions.sort()
+        defs = numbereddefs.get(stepnum, (lastdefs[stepnum],))
+        for i in xrange(len(defs)):
+            j = bisect.bisect_left(positions, defs[i])
+            if j == len(positions):
+                break
+            if i == len(defs) - 1 or positions[j] < defs[i+1]:
+                replaced.append( (positions[j], stepnum) )
+    replaced.sort()
+    return replaced
+
+# Optimizer
+#
+# optimize() rewrites a parsed program into one that behaves the same but runs
+# faster.  It removes the expression steps that can never be the best match for
+# any step number, because every step they match also matches expression steps
+# with better precedence.  An expression step an + b matches the step numbers
+# a(k + 1) + b + jM for j >= 0 in each of the M/a residue classes modulo M, where
+# M is a multiple of a.  When M is also a multiple of the a-values of some of the
+# better expression steps, each class either matches one of them from its first
+# step number on or it does not, so checking the first step number of each class
+# is enough.  M is grown from a as long as it stays below OPT_MAXCLASSES classes.
+#
+# It can also fold chains of Go to steps: a numbered step that goes to a numbered
+# Go to step that no Swap step can ever change is made to go straight to where
+# that step goes.  This saves steps, so it must not be done when the number of
+# steps executed or the steps themselves are shown.
+OPT_MAXCLASSES = 64
+
+# Returns the greatest common divisor of two positive integers.
+def gcd(a, b):
+    while b:
+        (a, b) = (b, a % b)
+    return a
+
+# Returns an optimized copy of program and a list of messages describing what was
+# changed.  Go to chains are only folded if foldgotos is true.
+def optimize(program, foldgotos = True):
+    messages = []
+    exprsteps = program[EXPRSTEPS]
+    kept = []
+    for prec in xrange(len(exprsteps)):
+        if subsumed(prec, program):
+            messages.append("Removed step %s, which is covered by later steps." %
+                            nexpr2str(exprsteps[prec][STEPA:STEPCODE]))
+        else:
+            kept.append(exprsteps[prec])
     
-    return (numberedsteps, exprsteps)
+    numberedsteps = program[NUMDSTEPS]
+    if foldgotos:
+        numberedsteps = dict(numberedsteps)
+        swappable = swaptargets(program)
+        for stepnum in program[NUMDINDEX]:
+            instr = numberedsteps[stepnum]
+            if instr[ICODE] != iGOTO:
+                continue
+            target = foldgoto(instr[ARG1], program, swappable)
+            if target != instr[ARG1]:
+                numberedsteps[stepnum] = (iGOTO, target, None)
+                messages.append("Step %d now goes to step %d instead of step %d." %
+                                (stepnum, target, instr[ARG1]))
+    
+    if len(kept) == len(exprsteps):
+        return ((numberedsteps, exprsteps, program[EXPRINDEX], program[NUMDINDEX]), messages)
+    return ((numberedsteps, kept, buildexprindex(kept), program[NUMDINDEX]), messages)
+
+# Returns whether every step number matching the expression step with precedence
+# prec also matches an expression step with better precedence.
+def subsumed(prec, program):
+    (a, b) = program[EXPRSTEPS][prec][STEPA:STEPCODE]
+    # the groups of better expression steps that keep M within OPT_MAXCLASSES classes
+    modulus = a
+    groups = []
+    for (c, classes, bestprec) in program[EXPRINDEX]:
+        if bestprec >= prec:
+            break
+        multiple = modulus // gcd(modulus, c) * c
+        if multiple // a <= OPT_MAXCLASSES:
+            modulus = multiple
+            groups.append( (c, classes) )
+    if not groups:
+        return False
+    
+    for k in xrange(modulus // a):
+        first = a * (k + 1) + b
+        for (c, classes) in groups:
+            found = False
+            for (rprec, d, step) in classes.get(first % c, ()):
+                if rprec >= prec:
+                    break
+                if first > d:
+                    found = True
+                    break
+            if found:
+                break
+        else:
+            return False
+    return True
+
+# Returns a function telling whether a step number can be the target of any Swap
+# step in program.
+def swaptargets(program):
+    numbered = set()
+    affine = set()
+    for instr in program[NUMDSTEPS].values():
+        if instr[ICODE] == iSWAP:
+            numbered.update(instr[ARG1:])
+    for (a, b, icode, a1, b1, a2, b2) in program[EXPRSTEPS]:
+        if icode == iSWAP:
+            for (c, d) in ((a1, b1), (a2, b2)):
+                if c == 0:
+                    numbered.add(d)
+                else:
+                    affine.add( (c, d) )
+    return lambda stepnum: stepnum in numbered or any(
+        stepnum > d and (stepnum - d) % c == 0 for (c, d) in affine)
+
+# Follows the chain of numbered Go to steps that no Swap step can change, starting
+# at stepnum, and returns the step where it ends.  Chains that loop are not folded.
+def foldgoto(stepnum, program, swappable):
+    seen = set()
+    target = stepnum
+    while True:
+        instr = program[NUMDSTEPS].get(target)
+        if instr is None or instr[ICODE] != iGOTO or swappable(target):
+            return target
+        if target in seen:
+            return stepnum
+        seen.add(target)
+        target = instr[ARG1]
 
 # Converts an "n"-expression tuple (a, b) into the string "an + b".
 def nexpr2str(nexpr):
@@ -327,173 +705,2456 @@ def expr2str(expr):
     else:
         return str(expr)
 
-# Returns true if stepnum matches the "n"-expression an + b for some positive n.
-def matchNexpression(stepnum, nexpr):
-    #  check whether an integer n exists that satisfies the equation an + b = stepnum
-    an = stepnum - nexpr[1]
-    (n, rem) = divmod(an, nexpr[0])
-    return rem == 0 and n > 0
+# Converts an expression step back into the text of its definition, such as
+# "Step 2n + 2. Go to step 6n + 3."
+def exprstep2str(step):
+    (a, b, icode, a1, b1, a2, b2) = step
+    args = []
+    for (c, d) in ((a1, b1), (a2, b2)):
+        if c == 0:
+            args.append(str(d))
+        elif c is not None:
+            args.append(nexpr2str((c, d)))
+    if icode == iSTOP:
+        instr = STOP
+    elif icode == iGOTO:
+        instr = "Go to step %s" % tuple(args)
+    elif icode == iSWAP:
+        instr = "Swap step %s with step %s" % tuple(args)
+    else:
+        instr = "Output character %s" % tuple(args)
+    return "Step %s. %s." % (nexpr2str((a, b)), instr)
 
 # Returns true if arg is a pair (a, b) representing an "n"-expression
 def isNexpr(arg):
     return type(arg) is tuple and len(arg) == 2
 
-# Searches a program for a step matching stepnum.  Returns a pair (stepnum, instruction)
-# if a match is found.  Returns None if no match found.
-def findstep(stepnum, program):
-    # look first for stepnum among the numbered steps
-    if program[NUMDSTEPS].has_key(stepnum):
-        return (stepnum, program[NUMDSTEPS][stepnum])
-    else:
-        # search for a matching expression step
-        for step in program[EXPRSTEPS]:
-            if matchNexpression(stepnum, step[NEXPR]):
-                return step
-    
-    # no match found
-    return None
-
-# Evaluate any expressions in the instruction portion of an expression step
-# and return the new instruction tuple.  Assumes that stepexpr has already
-# been checked to match curstepnum.
-def evalexprstep(curstepnum, stepexpr, instr):
+# Searches a program's expression steps for the one with the best precedence that
+# matches stepnum.  Returns the expression step or None if no match is found.
+def findexprstep(stepnum, program):
+    prec = findexprprec(stepnum, program)
+    if prec < 0:
+        return None
+    return program[EXPRSTEPS][prec]
+
+# Like findexprstep() but returns the precedence of the matching expression step,
+# which is its position in the expression step list, or -1 if no match is found.
+def findexprprec(stepnum, program):
+    # stepnum matches an + b for some positive n exactly when stepnum and b
+    # are in the same residue class modulo a and stepnum > b.
+    foundprec = len(program[EXPRSTEPS])
+    for (a, classes, bestprec) in program[EXPRINDEX]:
+        if bestprec >= foundprec:
+            # no remaining group can beat the current match
+            break
+        rules = classes.get(stepnum % a)
+        if rules:
+            for (prec, b, step) in rules:
+                if prec >= foundprec:
+                    break
+                if stepnum > b:
+                    foundprec = prec
+                    break
+    if foundprec == len(program[EXPRSTEPS]):
+        return -1
+    return foundprec
+
+# Evaluate the arguments of an expression step and return the new instruction
+# tuple.  Assumes that step has already been checked to match curstepnum.
+def evalexprstep(curstepnum, step):
+    (a, b, icode, a1, b1, a2, b2) = step
     #  solve the equation an + b = curstepnum for n
-    an = curstepnum - stepexpr[1]
-    n = an // stepexpr[0]
-    # evaluate the arguments of instr
-    if isNexpr(instr[ARG1]):
-        arg1 = instr[ARG1][0] * n + instr[ARG1][1]
+    n = (curstepnum - b) // a
+    if icode == iSWAP:
+        return (icode, a1 * n + b1, a2 * n + b2)
+    elif icode == iSTOP:
+        return STOPINSTR
     else:
-        arg1 = instr[ARG1]
-    if isNexpr(instr[ARG2]):
-        arg2 = instr[ARG2][0] * n + instr[ARG2][1]
+        return (icode, a1 * n + b1, None)
+
+# Searches a program for a step matching stepnum and returns the instruction
+# to execute or swap there.  Numbered steps are looked up first, then expression
+# steps.  If no step matches, the default STOP instruction is returned.
+def findstep(stepnum, program):
+    instr = program[NUMDSTEPS].get(stepnum)
+    if instr is None:
+        step = findexprstep(stepnum, program)
+        if step is None:
+            return STOPINSTR
+        instr = evalexprstep(stepnum, step)
+    return instr
+
+# Swap overlay
+#
+# Swaps never modify the program.  Instead execute() records them in an overlay
+# dictionary that maps a step number to the step whose original instruction it
+# now holds:
+#           step# -> source step#
+# The instruction at a step is the instruction that findstep() returns for its
+# source step (which is the step itself if it is not in the overlay).  An entry
+# is removed again as soon as the step holds the same instruction as it does in
+# the program, so the overlay only grows with the steps that are really changed.
+
+# Returns the instruction to execute at stepnum, using and filling the step
+# cache that maps step numbers to ready-to-execute instructions.  When the cache
+# grows past STEPCACHE_SIZE entries it is simply emptied again.  Steps wider than
+# STEPCACHE_MAXBITS bits are never cached: a program that keeps reaching new
+# steps of thousands of digits would otherwise fill the cache with huge numbers.
+# The transition memo and the block cache leave out such steps as well.
+STEPCACHE_SIZE = 65536
+STEPCACHE_MAXBITS = 256
+
+def cacheable(stepnum):
+    return stepnum.bit_length() <= STEPCACHE_MAXBITS
+
+def cachedstep(stepnum, program, overlay, cache):
+    instr = cache.get(stepnum)
+    if instr is None:
+        instr = findstep(overlay.get(stepnum, stepnum), program)
+        storestep(stepnum, instr, cache)
+    return instr
+
+def storestep(stepnum, instr, cache):
+    if cacheable(stepnum):
+        if len(cache) >= STEPCACHE_SIZE:
+            cache.clear()
+        cache[stepnum] = instr
+
+# Exchanges the instructions at steps target1 and target2 by updating the swap
+# overlay and the step cache.
+def swapsteps(target1, target2, program, overlay, cache):
+    source1 = overlay.get(target1, target1)
+    source2 = overlay.get(target2, target2)
+    instr1 = cachedstep(target1, program, overlay, cache)
+    instr2 = cachedstep(target2, program, overlay, cache)
+    setsource(target1, source2, instr2, program, overlay)
+    setsource(target2, source1, instr1, program, overlay)
+    storestep(target1, instr2, cache)
+    storestep(target2, instr1, cache)
+
+# Records in the swap overlay that stepnum now holds instr, the instruction from
+# step source.  Drops the entry if that is the instruction the program has there.
+def setsource(stepnum, source, instr, program, overlay):
+    if source == stepnum or instr == findstep(stepnum, program):
+        overlay.pop(stepnum, None)
     else:
-        arg2 = instr[ARG2]
+        overlay[stepnum] = source
 
-    return (instr[ICODE], arg1, arg2)
+# Affine fast-forward
+#
+# Programs often walk long runs of consecutive steps that all match the same
+# expression step n + b and do nothing, because its instruction swaps a step with
+# itself or goes to the next step.  fastforward() finds the end of such a run from
+# the program instead of executing each step: the run ends at the first later step
+# that is a numbered step, is in the swap overlay or matches an expression step
+# with better precedence.
+
+# Whether a step that is not in the swap overlay starts such a run depends only on
+# the program, so it is worked out once per step and kept in a dictionary
+#           step# -> precedence of the expression step n + b, or -1
+# that is bounded like the step cache.
 
-# Takes the result of findstep() as input 'step' plus the current step number
-# and makes sure that it is ready to be executed or swapped.
-def preparestep(step, curstep):
-    if step:
-        (stepnum, instr) = step
-        if isNexpr(stepnum):
-            instr = evalexprstep(curstep, stepnum, instr)
+# Returns the step where the run of do-nothing steps starting at stepnum ends, or
+# stepnum itself if the step at stepnum does not start such a run or the run
+# never ends.  fastrules is the dictionary of the steps that start runs.
+def fastforward(stepnum, program, overlay, fastrules):
+    if stepnum in overlay:
+        return stepnum
+    prec = fastrule(stepnum, program, fastrules)
+    if prec < 0:
+        return stepnum
+    
+    # the next numbered step
+    numbered = program[NUMDINDEX]
+    i = bisect.bisect_right(numbered, stepnum)
+    if i < len(numbered):
+        endstep = numbered[i]
     else:
-        # no step was found, so use the default STOP instruction
-        (stepnum, instr) = (curstep, (iSTOP, None, None))
+        endstep = None
+    # the next swapped step
+    for swapped in overlay:
+        if swapped > stepnum and (endstep is None or swapped < endstep):
+            endstep = swapped
+    # the next step matching an expression step with better precedence
+    for (c, classes, bestprec) in program[EXPRINDEX]:
+        if bestprec >= prec:
+            break
+        for (residue, rules) in classes.items():
+            for (rprec, d, step) in rules:
+                if rprec >= prec:
+                    break
+                # the first step after both stepnum and d in this residue class
+                nextstep = max(stepnum, d) + 1
+                nextstep += (residue - nextstep) % c
+                if endstep is None or nextstep < endstep:
+                    endstep = nextstep
+    
+    if endstep is None:
+        return stepnum
+    return endstep
 
-    # NOTE: stepnum may be an "n"-expression
-    return (stepnum, instr)
+# Returns the precedence of the expression step that makes stepnum the start of a
+# run of do-nothing steps when it is not swapped, or -1 if it is not, using and
+# filling fastrules.
+def fastrule(stepnum, program, fastrules):
+    prec = fastrules.get(stepnum)
+    if prec is None:
+        prec = -1
+        if stepnum not in program[NUMDSTEPS]:
+            prec = findexprprec(stepnum, program)
+        if prec >= 0:
+            (a, b, icode, a1, b1, a2, b2) = program[EXPRSTEPS][prec]
+            if a != 1 or not ((icode == iSWAP and a1 == a2 and b1 == b2) or
+                              (icode == iGOTO and a1 == 1 and b1 == b + 1)):
+                prec = -1
+        storestep(stepnum, prec, fastrules)
+    return prec
 
 # Output formats
 outINTEGER = 1
 outASCII = 2
 outUNICODE = 3
+outPACKED = 4
+
+# Flush policies
+flushFULL = 1       # write the buffer when it is full
+flushLINE = 2       # write the buffer after every newline
+flushALWAYS = 3     # write the buffer after every output
+
+DEFAULT_BUFSIZE = 65536
+WRITER_QUEUE_SIZE = 64
+
+# Output sink
+#
+# All output of a running program, including trace lines, goes through an
+# OutputSink that formats the values of 'Output character' instructions as bytes
+# and collects them in a buffer that is written to the stream according to the
+# flush policy.  Integers are written in decimal, one per line, or in the packed
+# binary format (see packinteger()).  Unicode characters are written in UTF-8.
+# Values that are out of range for ASCII or Unicode output are not written but
+# counted, and close() reports them with one warning per output format.
+# Optionally the buffers are written by a background thread.
+class OutputSink(object):
+    def __init__(self, stream, outformat = outINTEGER, bufsize = DEFAULT_BUFSIZE,
+                 flushpolicy = flushFULL, threaded = False):
+        # a Python 3 text stream closes its binary stream when it is collected,
+        # so it is kept for as long as the sink writes to the binary stream
+        self.textstream = stream
+        self.stream = stream = bytestream(stream)
+        self.textonly = textonly(stream)
+        self.outformat = outformat
+        self.encoding = 'latin-1'
+        if outformat == outUNICODE:
+            self.encoding = 'utf-8'
+        self.bufsize = bufsize
+        self.flushpolicy = flushpolicy
+        self.chunks = []
+        self.size = 0
+        self.badcount = 0       # number of values out of range
+        self.firstbad = None    # the first value out of range
+        self.unichars = {}      # UTF-8 encodings by code point
+        self.written = 0        # bytes passed to the stream
+        self.writer = None
+        if threaded:
+            self.writer = WriterThread(stream)
+            self.writer.start()
+    
+    # Formats an output value.  Returns None if it is out of range.
+    def format(self, value):
+        if self.outformat == outINTEGER:
+            return "%d\n" % value
+        elif self.outformat == outASCII:
+            if value >= 0 and value <= 127:
+                return chr(value)
+        elif self.outformat == outUNICODE:
+            if value >= 0 and value <= 65534:
+                text = self.unichars.get(value)
+                if text is None:
+                    text = self.unichars[value] = unicodechar(value)
+                return text
+        elif self.outformat == outPACKED:
+            return packinteger(value)
+        return None
+    
+    # Formats a list of output values.  Returns None if any is out of range.
+    def formatall(self, values):
+        texts = [self.format(value) for value in values]
+        if None in texts:
+            return None
+        return "".join(texts)
+    
+    # Performs the 'Output character' instruction for value.
+    def output(self, value):
+        text = self.format(value)
+        if text is None:
+            if self.badcount == 0:
+                self.firstbad = value
+            self.badcount += 1
+        elif self.flushpolicy == flushALWAYS:
+            self.write(text)
+            self.flush()
+        else:
+            self.write(text)
+    
+    # Performs the 'Output character' instructions for values that formatall()
+    # has formatted as text, flushing the buffer like output() does.
+    def outputtext(self, text):
+        self.write(text)
+        if self.flushpolicy == flushALWAYS:
+            self.flush()
+    
+    # Adds text to the buffer.
+    def write(self, text):
+        self.chunks.append(text)
+        self.size += len(text)
+        if self.size >= self.bufsize or (self.flushpolicy != flushFULL and "\n" in text):
+            self.flush()
+    
+    # Writes the buffer to the stream.
+    def flush(self):
+        if self.chunks:
+            data = encodeoutput("".join(self.chunks), self.encoding)
+            self.chunks = []
+            self.size = 0
+            self.written += len(data)
+            if self.textonly:
+                data = decodeoutput(data, self.encoding)
+            if self.writer:
+                self.writer.put(data)
+            else:
+                self.stream.write(data)
+                self.stream.flush()
+    
+    # Writes the buffer and waits until the background thread has written it too.
+    def sync(self):
+        self.flush()
+        if self.writer:
+            self.writer.sync()
+    
+    # Writes all remaining output and reports the values that were out of range.
+    def close(self):
+        try:
+            self.flush()
+            if self.writer:
+                self.writer.finish()
+        finally:
+            if self.badcount:
+                if self.outformat == outASCII:
+                    kind = "ASCII"
+                else:
+                    kind = "Unicode"
+                if self.badcount == 1:
+                    warning("%s char value %d out of range." % (kind, self.firstbad))
+                else:
+                    warning("%d %s char values out of range, starting with %d." %
+                            (self.badcount, kind, self.firstbad))
+                self.badcount = 0
+
+# Background thread used by an OutputSink to write its buffers.  An error that
+# occurs while writing is raised again by the next put() or by finish().
+class WriterThread(threading.Thread):
+    def __init__(self, stream):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.stream = stream
+        self.queue = queue.Queue(WRITER_QUEUE_SIZE)
+        self.error = None
+    
+    def run(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                break
+            if self.error is None:
+                try:
+                    self.stream.write(data)
+                    self.stream.flush()
+                except Exception as e:
+                    self.error = e
+            self.queue.task_done()
+    
+    def put(self, data):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(data)
+    
+    def sync(self):
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+    
+    def finish(self):
+        self.queue.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
 
-def execute(program, outformat = outINTEGER, startstep = 1, trace = False):
-    steps = program[NUMDSTEPS]     # dictionary of numbered steps
-    # exprsteps = program[EXPRSTEPS] # list of expression steps
+# Encodes an integer in the packed binary output format: the integer is mapped to
+# a non-negative one by zigzag encoding (0, -1, 1, -2, ... become 0, 1, 2, 3, ...)
+# and written seven bits per byte, least significant first, with the high bit of
+# every byte except the last one set.  This works for integers of any size.
+def packinteger(value):
+    if value < 0:
+        value = -2 * value - 1
+    else:
+        value = 2 * value
+    if value < 128:
+        return chr(value)
+    packed = []
+    while value >= 128:
+        packed.append(chr(value & 127 | 128))
+        value >>= 7
+    packed.append(chr(value))
+    return "".join(packed)
+
+# Run results
+#
+# The execution engines return a tuple
+#           (step#, steps executed, stopped)
+# where stopped is True if the program executed a Stop instruction at step# and
+# False if it reached the step limit with step# as the next step to execute.
+
+# Tuple indices for run results
+RSTEP = 0
+RCOUNT = 1
+RSTOPPED = 2
+
+# Runs a program one step at a time, executing at most maxsteps steps if given.
+# Returns the run result.  Output goes to sink if given, otherwise to a new
+# OutputSink for sys.stdout.  If memo is given, the program must not have Swap
+# steps and the run uses and extends the transition memo (see executememo())
+# unless it is traced.  If overlay is given, the run starts from and updates that
+# swap overlay, so that a run can be continued from where it reached a step limit.
+# The step cache for the overlay can be kept for the continued run as well.  If
+# maxexec is given, the run also ends after it has executed maxexec steps one at a
+# time, not counting the steps that it skipped by fast-forwarding.  That bounds
+# the time the run takes, however many steps it skips.
+def execute(program, outformat = outINTEGER, startstep = 1, trace = False, sink = None,
+            maxsteps = None, memo = None, overlay = None, cache = None, maxexec = None):
+    if sink is None:
+        sink = OutputSink(sys.stdout, outformat)
+        try:
+            return execute(program, outformat, startstep, trace, sink, maxsteps, memo, overlay, cache,
+                           maxexec)
+        finally:
+            sink.close()
+    if memo is not None and not trace:
+        return executememo(program, startstep, sink, maxsteps, memo)
+    
+    if overlay is None:
+        overlay = {}    # swapped steps -> their source steps
+    # Resolved instructions by step number.  Only swaps change how a step
+    # resolves, so the cache stays valid as long as the swap targets are updated.
+    if cache is None:
+        cache = {}
+    # Runs of do-nothing steps are skipped unless they are traced as text.
+    # A binary trace records them in bulk.
+    fastfwd = not trace or isinstance(trace, TraceBuffer)
+    fastrules = {}  # step# -> expression step of a run starting there (see fastforward())
     curstep = startstep
-    done = False
-    while not done:
-        step = findstep(curstep, program)
-        (stepnum, instr) = preparestep(step, curstep)
+    count = 0       # steps executed
+    if maxsteps is None:
+        maxsteps = -1
+    limit = steplimit(maxsteps, maxexec)
+    while count != limit:
+        instr = cache.get(curstep)
+        if instr is None:
+            instr = cachedstep(curstep, program, overlay, cache)
         if trace:
-            print STEP, curstep,
-            printinstruction(instr)
+            traceinstruction(trace, sink, curstep, instr)
+        count += 1
         
         # execute the current step
         instrcode = instr[ICODE]
-        if instr[ICODE] == iSTOP:
-            done = True
+        if instrcode == iSTOP:
+            return (curstep, count, True)
         
-        elif instr[ICODE] == iGOTO:
-            curstep = instr[ARG1]
+        elif instrcode == iGOTO:
+            nextstep = instr[ARG1]
+            if nextstep == curstep + 1 and fastfwd and fastrules.get(curstep, 0) >= 0:
+                endstep = fastforward(curstep, program, overlay, fastrules)
+                if endstep > nextstep:
+                    if maxsteps >= 0:
+                        endstep = min(endstep, nextstep + maxsteps - count)
+                    if trace:
+                        trace.recordrun(nextstep, endstep, program)
+                    count += endstep - nextstep
+                    limit = skiplimit(limit, endstep - nextstep, maxsteps)
+                    nextstep = endstep
+            curstep = nextstep
         
-        elif instr[ICODE] == iSWAP:
-            # get the target steps
-            target1 = instr[ARG1]
-            target2 = instr[ARG2]
-            (stepnum1, instr1) = preparestep(findstep(target1, program), target1)
-            (stepnum2, instr2) = preparestep(findstep(target2, program), target2)
-            # swap them in the program's numbered steps
-            steps[target1] = instr2
-            steps[target2] = instr1
+        elif instrcode == iSWAP:
+            if instr[ARG1] == instr[ARG2] and fastfwd and fastrules.get(curstep, 0) >= 0:
+                endstep = fastforward(curstep, program, overlay, fastrules)
+                if endstep != curstep:
+                    if maxsteps >= 0:
+                        endstep = min(endstep, curstep + 1 + maxsteps - count)
+                    if trace:
+                        trace.recordrun(curstep + 1, endstep, program)
+                    count += endstep - curstep - 1
+                    limit = skiplimit(limit, endstep - curstep - 1, maxsteps)
+                    curstep = endstep
+                    continue
+            swapsteps(instr[ARG1], instr[ARG2], program, overlay, cache)
             curstep += 1
         
-        elif instr[ICODE] == iOUTP:
-            if outformat == outINTEGER:
-                print instr[ARG1]
-            elif outformat == outASCII:
-                if instr[ARG1] >= 0 and instr[ARG1] <= 127:
-                    sys.stdout.write(chr(instr[ARG1]))
-                else:
-                    warning("ASCII char value %d out of range." % instr[ARG1])
-            elif outformat == outUNICODE:
-                if instr[ARG1] >= 0 and instr[ARG1] <= 65534:
-                    sys.stdout.write(unichr(instr[ARG1]))
-                else:
-                    warning("Unicode char value %d out of range." % instr[ARG1])
+        elif instrcode == iOUTP:
+            sink.output(instr[ARG1])
             curstep += 1
         
-    return curstep
+    return (curstep, count, False)
+
+# Returns the number of steps after which a run with the limits maxsteps (-1 for
+# none) and maxexec (see execute()) ends, as long as it skips no steps.
+def steplimit(maxsteps, maxexec):
+    if maxexec is not None and (maxsteps < 0 or maxexec < maxsteps):
+        return maxexec
+    return maxsteps
+
+# Returns the new limit from steplimit() after the run skipped skipped steps by
+# fast-forwarding, which do not count towards maxexec.
+def skiplimit(limit, skipped, maxsteps):
+    if limit == maxsteps:
+        return limit
+    limit += skipped
+    if 0 <= maxsteps < limit:
+        return maxsteps
+    return limit
+
+# Transition memo
+#
+# In a program without Swap steps, the step that follows each step never changes.
+# executememo() runs such a program like execute() but keeps what it learns in a
+# memo dictionary that is shared by many runs:
+#           step# -> (step#, steps, output values, stopped)
+# meaning that from the first step# the program reaches the second one after
+# executing the given number of steps and outputting the values, and stops there
+# if stopped is true.  An entry first covers a single step.  Afterwards the
+# entries along the path of each run are joined, union-find style, so that a
+# later run that reaches a step of the path jumps straight to its end.  Entries
+# are not joined if they would hold more than MEMO_MAXOUTPUTS values and the
+# whole memo is emptied when it grows past MEMO_SIZE entries.  Like the step
+# cache, the memo leaves out steps wider than STEPCACHE_MAXBITS bits.
+MEMO_SIZE = 1 << 17
+MEMO_MAXOUTPUTS = 64
+MEMO_PATHLEN = 4096     # the number of entries used before joining them
+
+# Tuple indices for memo entries
+MNEXT = 0
+MCOUNT = 1
+MOUTPUTS = 2
+MSTOPPED = 3
+
+# Runs a program without Swap steps from startstep using the transition memo.
+# Returns the run result.
+def executememo(program, startstep, sink, maxsteps, memo):
+    output = sink.output
+    path = []       # the steps and memo entries used since the last join
+    curstep = startstep
+    count = 0       # steps executed
+    if maxsteps is None:
+        maxsteps = -1
+    while count != maxsteps:
+        entry = memo.get(curstep)
+        if entry is None:
+            entry = memostep(curstep, program)
+            if cacheable(curstep):
+                if len(memo) >= MEMO_SIZE:
+                    memo.clear()
+                memo[curstep] = entry
+        if maxsteps >= 0 and count + entry[MCOUNT] > maxsteps:
+            # the entry goes past the step limit, so execute the rest one step at a time
+            joinpath(path, memo)
+            result = execute(program, None, curstep, False, sink, maxsteps - count)
+            return (result[RSTEP], count + result[RCOUNT], result[RSTOPPED])
+        
+        for value in entry[MOUTPUTS]:
+            output(value)
+        count += entry[MCOUNT]
+        if cacheable(curstep):
+            path.append( (curstep, entry) )
+        else:
+            # too wide to be kept, so the path is joined up to here
+            joinpath(path, memo)
+            path = []
+        if entry[MSTOPPED]:
+            joinpath(path, memo)
+            return (entry[MNEXT], count, True)
+        if len(path) >= MEMO_PATHLEN:
+            joinpath(path, memo)
+            path = []
+        curstep = entry[MNEXT]
+    
+    joinpath(path, memo)
+    return (curstep, count, False)
+
+# Returns the memo entry for the single step at stepnum.
+def memostep(stepnum, program):
+    instr = findstep(stepnum, program)
+    if instr[ICODE] == iSTOP:
+        return (stepnum, 1, (), True)
+    elif instr[ICODE] == iGOTO:
+        return (instr[ARG1], 1, (), False)
+    else:
+        return (stepnum + 1, 1, (instr[ARG1],), False)
+
+# Joins the memo entries along a path of (step#, memo entry) pairs where each
+# entry leads to the next step of the path.  Each step is updated to lead as far
+# along the path as possible.
+def joinpath(path, memo):
+    suffix = None
+    for (stepnum, entry) in reversed(path):
+        if suffix is not None and len(entry[MOUTPUTS]) + len(suffix[MOUTPUTS]) <= MEMO_MAXOUTPUTS:
+            suffix = (suffix[MNEXT], entry[MCOUNT] + suffix[MCOUNT],
+                      entry[MOUTPUTS] + suffix[MOUTPUTS], suffix[MSTOPPED])
+        else:
+            suffix = entry
+        memo[stepnum] = suffix
+
+# Basic-block execution engine
+#
+# executeblocks() runs a program exactly like execute() but first compiles each
+# straight-line run of Output and Go to steps into a block, a tuple
+#           (step#s, instructions, output values, output text, next step#)
+# holding the steps and instructions in execution order, the values they output,
+# those values already formatted (or None if they cannot be written at once) and
+# the step that follows the block.  A block ends before a Swap or Stop step,
+# before a step that it already contains or after BLOCK_MAXLEN steps.  Blocks are
+# kept by their first step and a swap only discards the blocks containing one of
+# its targets.  The whole block cache is emptied if it grows past BLOCKCACHE_SIZE
+# and blocks with steps wider than STEPCACHE_MAXBITS bits are not kept at all.
+# Like execute(), it can continue a run from a given swap overlay and step cache
+# and limit the steps executed one at a time.
+BLOCK_MAXLEN = 256
+BLOCKCACHE_SIZE = 16384
+
+# Tuple indices for blocks
+BSTEPS = 0
+BINSTRS = 1
+BOUTPUTS = 2
+BTEXT = 3
+BNEXT = 4
+
+def executeblocks(program, outformat = outINTEGER, startstep = 1, trace = False, sink = None,
+                  maxsteps = None, overlay = None, cache = None, maxexec = None):
+    if sink is None:
+        sink = OutputSink(sys.stdout, outformat)
+        try:
+            return executeblocks(program, outformat, startstep, trace, sink, maxsteps, overlay, cache,
+                                 maxexec)
+        finally:
+            sink.close()
+    
+    if overlay is None:
+        overlay = {}    # swapped steps -> their source steps
+    if cache is None:
+        cache = {}  # step# -> resolved instruction
+    blocks = {}     # first step# -> block
+    members = {}    # step# -> set of first step#s of the blocks containing it
+    fastfwd = not trace or isinstance(trace, TraceBuffer)
+    fastrules = {}  # step# -> expression step of a run starting there (see fastforward())
+    curstep = startstep
+    count = 0       # steps executed
+    if maxsteps is None:
+        maxsteps = -1
+    limit = steplimit(maxsteps, maxexec)
+    while count != limit:
+        block = blocks.get(curstep)
+        if block is None:
+            block = compileblock(curstep, program, overlay, cache, fastrules, sink)
+            if block is not None and all(cacheable(stepnum) for stepnum in block[BSTEPS]):
+                if len(blocks) >= BLOCKCACHE_SIZE:
+                    blocks.clear()
+                    members.clear()
+                blocks[curstep] = block
+                for stepnum in block[BSTEPS]:
+                    members.setdefault(stepnum, set()).add(curstep)
+        
+        if block is None:
+            # a Swap or Stop step or the start of a run of do-nothing steps, which
+            # is executed on its own
+            instr = cachedstep(curstep, program, overlay, cache)
+            if trace:
+                traceinstruction(trace, sink, curstep, instr)
+            count += 1
+            if instr[ICODE] == iSTOP:
+                return (curstep, count, True)
+            if instr[ICODE] == iGOTO:
+                nextstep = instr[ARG1]
+                if fastfwd:
+                    endstep = fastforward(curstep, program, overlay, fastrules)
+                    if endstep > nextstep:
+                        if maxsteps >= 0:
+                            endstep = min(endstep, nextstep + maxsteps - count)
+                        if trace:
+                            trace.recordrun(nextstep, endstep, program)
+                        count += endstep - nextstep
+                        limit = skiplimit(limit, endstep - nextstep, maxsteps)
+                        nextstep = endstep
+                curstep = nextstep
+                continue
+            if instr[ARG1] == instr[ARG2] and fastfwd:
+                endstep = fastforward(curstep, program, overlay, fastrules)
+                if endstep != curstep:
+                    if maxsteps >= 0:
+                        endstep = min(endstep, curstep + 1 + maxsteps - count)
+                    if trace:
+                        trace.recordrun(curstep + 1, endstep, program)
+                    count += endstep - curstep - 1
+                    limit = skiplimit(limit, endstep - curstep - 1, maxsteps)
+                    curstep = endstep
+                    continue
+            swapsteps(instr[ARG1], instr[ARG2], program, overlay, cache)
+            for target in instr[ARG1:]:
+                for firststep in members.pop(target, ()):
+                    dropblock(firststep, blocks, members)
+            curstep += 1
+            continue
+        
+        # run the block
+        length = len(block[BSTEPS])
+        if limit >= 0 and count + length > limit:
+            # run only the steps left before the limit
+            length = limit - count
+            for i in xrange(length):
+                instr = block[BINSTRS][i]
+                if trace:
+                    traceinstruction(trace, sink, block[BSTEPS][i], instr)
+                if instr[ICODE] == iOUTP:
+                    sink.output(instr[ARG1])
+            count += length
+            curstep = block[BSTEPS][length]
+            break
+        elif trace:
+            instrs = block[BINSTRS]
+            for i in xrange(len(instrs)):
+                traceinstruction(trace, sink, block[BSTEPS][i], instrs[i])
+                if instrs[i][ICODE] == iOUTP:
+                    sink.output(instrs[i][ARG1])
+        elif block[BTEXT] is not None:
+            sink.outputtext(block[BTEXT])
+        else:
+            for value in block[BOUTPUTS]:
+                sink.output(value)
+        count += length
+        curstep = block[BNEXT]
+    
+    return (curstep, count, False)
+
+# Discards the block starting at firststep, if there is one, and removes it from
+# the members of all of its steps.
+def dropblock(firststep, blocks, members):
+    block = blocks.pop(firststep, None)
+    if block is None:
+        return
+    for stepnum in block[BSTEPS]:
+        firststeps = members.get(stepnum)
+        if firststeps is not None:
+            firststeps.discard(firststep)
+            if not firststeps:
+                del members[stepnum]
+
+# Compiles the block starting at stepnum.  Returns None if the step at stepnum
+# is a Swap or Stop or starts a run of do-nothing steps, which executeblocks()
+# fast-forwards like execute() does.
+def compileblock(stepnum, program, overlay, cache, fastrules, sink):
+    steps = []
+    instrs = []
+    outputs = []
+    seen = set()
+    while len(steps) < BLOCK_MAXLEN and stepnum not in seen:
+        instr = cachedstep(stepnum, program, overlay, cache)
+        if instr[ICODE] == iOUTP:
+            outputs.append(instr[ARG1])
+            nextstep = stepnum + 1
+        elif instr[ICODE] == iGOTO:
+            nextstep = instr[ARG1]
+            if (nextstep == stepnum + 1 and stepnum not in overlay and
+                fastrule(stepnum, program, fastrules) >= 0):
+                break
+        else:
+            break
+        seen.add(stepnum)
+        steps.append(stepnum)
+        instrs.append(instr)
+        stepnum = nextstep
+    
+    if not steps:
+        return None
+    return (tuple(steps), tuple(instrs), tuple(outputs), sink.formatall(outputs), stepnum)
+
+# Execution profiles
+#
+# executeprofile() runs a program exactly like execute() but counts what it does
+# in a Profile: how often each step is executed, how often the instructions of
+# each expression step are executed, how often steps are looked up in the program
+# and how deep a scan of the expression steps in precedence order goes before it
+# finds the match, how often each step is swapped and how often a step falls back
+# to the default Stop instruction.  It does not fast-forward, so that every step
+# is counted.  execute() itself never pays for any of this.  A long run can execute
+# a great many different steps, so only the PROFILE_MAXSTEPS most executed and
+# most swapped steps are counted one by one; when there are more, the least
+# executed half of them is dropped and only counted in total.
+
+# Rules of the program that an instruction can come from, besides the expression
+# steps which are identified by their precedence
+RULE_NUMBERED = -1
+RULE_DEFAULT = -2
+
+PROFILE_TOP = 20            # the number of steps listed in text reports
+PROFILE_MAXSTEPS = 65536    # the number of steps whose hits and swaps are kept
+
+class Profile(object):
+    def __init__(self, program):
+        self.program = program
+        self.steps = 0          # steps executed
+        self.seconds = 0.0      # time spent executing them
+        self.stephits = {}      # step# -> times executed
+        self.otherhits = 0      # times that steps dropped from stephits were executed
+        self.rulehits = {}      # rule -> steps executed with an instruction from rule
+        self.lookups = {}       # rule -> lookups that found rule
+        self.swapcount = 0      # Swap instructions executed
+        self.swaps = {}         # step# -> times swapped
+        self.otherswaps = 0     # times that steps dropped from swaps were swapped
+    
+    # Looks up the instruction at stepnum, which comes from the step source.
+    # Returns a pair (instruction, rule).
+    def lookup(self, stepnum, source):
+        program = self.program
+        instr = program[NUMDSTEPS].get(source)
+        if instr is not None:
+            rule = RULE_NUMBERED
+        else:
+            rule = findexprprec(source, program)
+            if rule < 0:
+                rule = RULE_DEFAULT
+                instr = STOPINSTR
+            else:
+                instr = evalexprstep(source, program[EXPRSTEPS][rule])
+        self.lookups[rule] = self.lookups.get(rule, 0) + 1
+        return (instr, rule)
+    
+    # Returns a dictionary mapping each scan depth to the number of lookups that
+    # scanned that many expression steps.  Numbered steps are found without a scan
+    # and a lookup that falls back to the default Stop scans every expression step.
+    def depths(self):
+        histogram = {}
+        for (rule, count) in self.lookups.items():
+            if rule == RULE_NUMBERED:
+                depth = 0
+            elif rule == RULE_DEFAULT:
+                depth = len(self.program[EXPRSTEPS])
+            else:
+                depth = rule + 1
+            histogram[depth] = histogram.get(depth, 0) + count
+        return histogram
+    
+    # Returns the profile as a dictionary that can be written as JSON.
+    def todict(self):
+        exprsteps = self.program[EXPRSTEPS]
+        rules = []
+        for prec in xrange(len(exprsteps) - 1, -1, -1):
+            rules.append({"step": exprstep2str(exprsteps[prec]),
+                          "hits": self.rulehits.get(prec, 0),
+                          "lookups": self.lookups.get(prec, 0)})
+        return {"steps": self.steps,
+                "seconds": self.seconds,
+                "steps_per_second": self.steps / max(self.seconds, 1e-9),
+                "step_hits": dict((str(stepnum), count) for (stepnum, count) in self.stephits.items()),
+                "other_step_hits": self.otherhits,
+                "numbered_hits": self.rulehits.get(RULE_NUMBERED, 0),
+                "expression_hits": rules,
+                "default_stop_hits": self.rulehits.get(RULE_DEFAULT, 0),
+                "lookups": sum(self.lookups.values()),
+                "numbered_lookups": self.lookups.get(RULE_NUMBERED, 0),
+                "default_stop_lookups": self.lookups.get(RULE_DEFAULT, 0),
+                "scan_depths": dict((str(depth), count) for (depth, count) in self.depths().items()),
+                "swaps": self.swapcount,
+                "swap_targets": dict((str(stepnum), count) for (stepnum, count) in self.swaps.items()),
+                "other_swap_targets": self.otherswaps}
+    
+    # Returns the profile as a text report.
+    def totext(self):
+        lines = []
+        lines.append("Steps executed:       %d in %.3f seconds (%.0f steps/s)" %
+                     (self.steps, self.seconds, self.steps / max(self.seconds, 1e-9)))
+        lines.append("Default Stop:         %d steps, %d lookups" %
+                     (self.rulehits.get(RULE_DEFAULT, 0), self.lookups.get(RULE_DEFAULT, 0)))
+        lines.append("Lookups:              %d (%d numbered steps)" %
+                     (sum(self.lookups.values()), self.lookups.get(RULE_NUMBERED, 0)))
+        lines.append("Swaps:                %d" % self.swapcount)
+        
+        lines.append("")
+        lines.append("Most executed steps:")
+        for (stepnum, count) in toplist(self.stephits):
+            lines.append("  %12d  Step %d" % (count, stepnum))
+        if self.otherhits:
+            lines.append("  %12d  steps executed too rarely to be counted one by one" % self.otherhits)
+        
+        lines.append("")
+        lines.append("Steps executed by rule:")
+        lines.append("          hits   lookups")
+        lines.append("  %12d %9d  numbered steps" % (self.rulehits.get(RULE_NUMBERED, 0),
+                                                     self.lookups.get(RULE_NUMBERED, 0)))
+        exprsteps = self.program[EXPRSTEPS]
+        for prec in xrange(len(exprsteps) - 1, -1, -1):
+            hits = self.rulehits.get(prec, 0)
+            lookups = self.lookups.get(prec, 0)
+            if hits or lookups:
+                lines.append("  %12d %9d  %s" % (hits, lookups, exprstep2str(exprsteps[prec])))
+        
+        lines.append("")
+        lines.append("Expression steps scanned per lookup:")
+        histogram = {}
+        for (depth, count) in self.depths().items():
+            # group the depths by powers of two
+            low = 1
+            while depth >= 2 * low:
+                low *= 2
+            if depth == 0:
+                low = 0
+            histogram[low] = histogram.get(low, 0) + count
+        for low in sorted(histogram):
+            if low < 2:
+                label = str(low)
+            else:
+                label = "%d-%d" % (low, 2 * low - 1)
+            lines.append("  %12s  %d" % (label, histogram[low]))
+        
+        if self.swaps:
+            lines.append("")
+            lines.append("Most swapped steps:")
+            for (stepnum, count) in toplist(self.swaps):
+                lines.append("  %12d  Step %d" % (count, stepnum))
+            if self.otherswaps:
+                lines.append("  %12d  swaps of steps swapped too rarely to be counted one by one" %
+                             self.otherswaps)
+        return "\n".join(lines) + "\n"
+
+# Writes the report of profile in the format reportformat ('text' or 'json') to
+# the text stream f, or to stderr if no stream is given.
+def writeprofile(profile, reportformat, f = None):
+    if reportformat == 'json':
+        text = json.dumps(profile.todict(), indent = 1, sort_keys = True, separators = (",", ": ")) + "\n"
+    else:
+        text = profile.totext()
+    if f is None:
+        f = sys.stderr
+    f.write(text)
+    f.flush()
+
+# Returns the PROFILE_TOP largest entries of a dictionary of counts as a list of
+# (key, count) pairs.
+def toplist(counts):
+    return sorted(counts.items(), key = lambda item: (-item[1], item[0]))[:PROFILE_TOP]
+
+# Removes the smaller half of the entries from a dictionary of counts that has
+# reached PROFILE_MAXSTEPS entries.  Returns the sum of the removed counts.
+def prunecounts(counts):
+    entries = sorted(counts.items(), key = lambda item: -item[1])
+    counts.clear()
+    counts.update(entries[:PROFILE_MAXSTEPS // 2])
+    return sum(count for (key, count) in entries[PROFILE_MAXSTEPS // 2:])
+
+# Runs a program like execute() and adds what it does to profile.
+def executeprofile(program, outformat = outINTEGER, startstep = 1, trace = False, sink = None,
+                   maxsteps = None, profile = None):
+    if sink is None:
+        sink = OutputSink(sys.stdout, outformat)
+        try:
+            return executeprofile(program, outformat, startstep, trace, sink, maxsteps, profile)
+        finally:
+            sink.close()
+    if profile is None:
+        profile = Profile(program)
+    
+    overlay = {}    # swapped steps -> their source steps
+    cache = {}      # step# -> (resolved instruction, rule)
+    stephits = profile.stephits
+    rulehits = profile.rulehits
+    swaps = profile.swaps
+    curstep = startstep
+    count = 0       # steps executed
+    if maxsteps is None:
+        maxsteps = -1
+    started = time.time()
+    try:
+        while count != maxsteps:
+            entry = cache.get(curstep)
+            if entry is None:
+                entry = profile.lookup(curstep, overlay.get(curstep, curstep))
+                storestep(curstep, entry, cache)
+            (instr, rule) = entry
+            if trace:
+                traceinstruction(trace, sink, curstep, instr)
+            count += 1
+            hits = stephits.get(curstep)
+            if hits is None:
+                if len(stephits) >= PROFILE_MAXSTEPS:
+                    profile.otherhits += prunecounts(stephits)
+                hits = 0
+            stephits[curstep] = hits + 1
+            rulehits[rule] = rulehits.get(rule, 0) + 1
+            
+            if instr[ICODE] == iSTOP:
+                return (curstep, count, True)
+            
+            elif instr[ICODE] == iGOTO:
+                curstep = instr[ARG1]
+            
+            elif instr[ICODE] == iSWAP:
+                profile.swapcount += 1
+                for target in set(instr[ARG1:]):
+                    if target not in swaps and len(swaps) >= PROFILE_MAXSTEPS:
+                        profile.otherswaps += prunecounts(swaps)
+                    swaps[target] = swaps.get(target, 0) + 1
+                targets = []
+                for target in instr[ARG1:]:
+                    entry = cache.get(target)
+                    if entry is None:
+                        entry = profile.lookup(target, overlay.get(target, target))
+                        storestep(target, entry, cache)
+                    targets.append( (target, overlay.get(target, target), entry) )
+                ((target1, source1, entry1), (target2, source2, entry2)) = targets
+                setsource(target1, source2, entry2[0], program, overlay)
+                setsource(target2, source1, entry1[0], program, overlay)
+                storestep(target1, entry2, cache)
+                storestep(target2, entry1, cache)
+                curstep += 1
+            
+            elif instr[ICODE] == iOUTP:
+                sink.output(instr[ARG1])
+                curstep += 1
+        
+        return (curstep, count, False)
+    finally:
+        profile.steps += count
+        profile.seconds += time.time() - started
+
+# Lockstep batch execution
+#
+# A program without Swap steps never changes, so the state of a run is just its
+# current step.  executebatch() runs such a program from many start steps at once
+# by keeping the current steps of all runs in a NumPy array and advancing them
+# together.  Each step is resolved for all runs with a few array operations: the
+# numbered steps are found with a binary search and the expression steps are
+# matched in precedence order, so that the best matching expression step wins for
+# every run.  Runs retire as they stop.  The arrays hold 64-bit integers, so a run
+# whose next step could overflow is finished by execute() instead.  The results
+# are the same as those of Interpreter.run().
+BATCH_SIZE = 4096
+BATCH_MAXINT = 2**63 - 1
 
-# Expects a tuple of the form (instruction code, arg1, arg2)
-def printinstruction(instr):
+# NumPy is optional and takes a while to import, so it is only imported when it
+# is needed.  Returns true if NumPy is available.
+numpy = None
+
+def havenumpy():
+    global numpy
+    if numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+    return numpy is not False
+
+# Returns true if program has no Swap steps.
+def swapfree(program):
+    for instr in program[NUMDSTEPS].values():
+        if instr[ICODE] == iSWAP:
+            return False
+    for step in program[EXPRSTEPS]:
+        if step[STEPCODE] == iSWAP:
+            return False
+    return True
+
+# Builds the tables used by executebatch() for a program without Swap steps.
+# Returns a tuple (numbered step#s, their instruction codes, their arguments,
+# expression steps, largest safe step#) where the first three are arrays and the
+# expression steps are tuples (a, b, instruction code, a1, b1).  From a step up to
+# the largest safe step#, the next step and all output values fit into 64 bits.
+# Returns None if the numbers in the program are too large.
+def batchtables(program):
+    numkeys = program[NUMDINDEX]
+    instrs = [program[NUMDSTEPS][stepnum] for stepnum in numkeys]
+    numargs = [instr[ARG1] or 0 for instr in instrs]
+    exprsteps = [(a, b, icode, a1 or 0, b1 or 0)
+                 for (a, b, icode, a1, b1, a2, b2) in program[EXPRSTEPS]]
+    biggest = max(numkeys + numargs + [max(step) for step in exprsteps] + [0])
+    if biggest > BATCH_MAXINT // 2:
+        return None
+    factor = max([step[3] for step in exprsteps] + [1])
+    return (numpy.array(numkeys, dtype = numpy.int64),
+            numpy.array([instr[ICODE] for instr in instrs], dtype = numpy.int64),
+            numpy.array(numargs, dtype = numpy.int64),
+            exprsteps, (BATCH_MAXINT - biggest) // factor - 1)
+
+# Runs a program without Swap steps from each step in startsteps, executing at
+# most maxsteps steps per run if given.  Returns the list of run results with the
+# output values added, in the order of startsteps.
+def executebatch(program, startsteps, maxsteps = None):
+    if not havenumpy():
+        raise ImportError("executebatch() requires NumPy")
+    tables = batchtables(program)
+    if tables is None:
+        safe = -1
+    else:
+        (numkeys, numcodes, numargs, exprsteps, safe) = tables
+    if maxsteps is None:
+        maxsteps = -1
+    # The results hold only the output values of the runs finished by execute()
+    # until the values output in lockstep are added at the end.
+    results = [None] * len(startsteps)
+    lanes = []      # the runs that are executed in lockstep
+    for i in xrange(len(startsteps)):
+        if abs(startsteps[i]) <= safe:
+            lanes.append(i)
+        else:
+            results[i] = finishbatchrun(program, startsteps[i], 0, maxsteps)
+    
+    lanes = numpy.array(lanes, dtype = numpy.int64)
+    cur = numpy.array([startsteps[i] for i in lanes], dtype = numpy.int64)
+    outlanes = []   # for each step, the runs that output a value
+    outvalues = []  # and the values they output
+    count = 0
+    while len(lanes) and count != maxsteps:
+        # the runs that could overflow continue with execute()
+        big = cur > safe
+        if big.any():
+            for (i, stepnum) in zip(lanes[big].tolist(), cur[big].tolist()):
+                results[i] = finishbatchrun(program, stepnum, count, maxsteps)
+            lanes = lanes[~big]
+            cur = cur[~big]
+            continue
+        
+        (codes, args) = resolvebatch(cur, numkeys, numcodes, numargs, exprsteps)
+        count += 1
+        out = codes == iOUTP
+        if out.any():
+            outlanes.append(lanes[out])
+            outvalues.append(args[out])
+        stop = codes == iSTOP
+        if stop.any():
+            for (i, stepnum) in zip(lanes[stop].tolist(), cur[stop].tolist()):
+                results[i] = (stepnum, count, True, [])
+            go = ~stop
+            lanes = lanes[go]
+            cur = cur[go]
+            codes = codes[go]
+            args = args[go]
+        cur = numpy.where(codes == iGOTO, args, cur + 1)
+    
+    # the runs that reached the step limit
+    for (i, stepnum) in zip(lanes.tolist(), cur.tolist()):
+        results[i] = (stepnum, count, False, [])
+    
+    # add the values output in lockstep, sorting them by run but keeping their order
+    if outlanes:
+        outlanes = numpy.concatenate(outlanes)
+        order = numpy.argsort(outlanes, kind = 'mergesort')
+        outvalues = numpy.concatenate(outvalues)[order].tolist()
+        bounds = numpy.searchsorted(outlanes[order], numpy.arange(len(startsteps) + 1)).tolist()
+        for i in xrange(len(startsteps)):
+            if bounds[i] < bounds[i+1]:
+                (stepnum, count, stopped, values) = results[i]
+                results[i] = (stepnum, count, stopped, outvalues[bounds[i]:bounds[i+1]] + values)
+    return results
+
+# Resolves the instructions at the steps in the array cur.  Returns a pair of
+# arrays (instruction codes, first arguments).
+def resolvebatch(cur, numkeys, numcodes, numargs, exprsteps):
+    codes = numpy.full(len(cur), iSTOP, dtype = numpy.int64)
+    args = numpy.zeros(len(cur), dtype = numpy.int64)
+    unmatched = numpy.ones(len(cur), dtype = bool)
+    if len(numkeys):
+        pos = numpy.minimum(numpy.searchsorted(numkeys, cur), len(numkeys) - 1)
+        hit = numkeys[pos] == cur
+        codes[hit] = numcodes[pos[hit]]
+        args[hit] = numargs[pos[hit]]
+        unmatched = ~hit
+    # expression steps in precedence order
+    for (a, b, icode, a1, b1) in exprsteps:
+        if not unmatched.any():
+            break
+        match = unmatched & (cur > b) & ((cur - b) % a == 0)
+        if match.any():
+            codes[match] = icode
+            args[match] = a1 * ((cur[match] - b) // a) + b1
+            unmatched &= ~match
+    return (codes, args)
+
+# Finishes a run of executebatch() with execute() from stepnum after count steps.
+# Returns the run result.
+def finishbatchrun(program, stepnum, count, maxsteps):
+    if maxsteps >= 0:
+        limit = maxsteps - count
+    else:
+        limit = None
+    sink = ListSink()
+    result = execute(program, None, stepnum, False, sink, limit)
+    return (result[RSTEP], count + result[RCOUNT], result[RSTOPPED], sink.values)
+
+# Traces the instruction executed at stepnum.  If trace is a TraceBuffer, it
+# records the instruction, otherwise a trace line is written to sink.
+def traceinstruction(trace, sink, stepnum, instr):
+    if isinstance(trace, TraceBuffer):
+        trace.record(stepnum, instr)
+    else:
+        sink.write("%s %s %s\n" % (STEP, stepnum, instr2str(instr)))
+
+# Converts an instruction tuple into the text used for tracing.
+def instr2str(instr):
     if instr[ICODE] == iSTOP:
-        print STOP
+        return STOP
     elif instr[ICODE] == iGOTO:
-        print GO, TO, instr[ARG1]
+        return "%s %s %s" % (GO, TO, instr[ARG1])
     elif instr[ICODE] == iSWAP:
-        print SWAP, instr[ARG1], instr[ARG2]
+        return "%s %s %s" % (SWAP, instr[ARG1], instr[ARG2])
     elif instr[ICODE] == iOUTP:
-        print OUTPUT, instr[ARG1]
+        return "%s %s" % (OUTPUT, instr[ARG1])
 
-# MAIN program
+# Binary traces
+#
+# A text trace of a long run is slow to write and very large.  A TraceBuffer
+# records the traced steps instead as fixed-size binary records
+#           opcode, step#, arg1, arg2
+# where the arguments of Stop, and the second argument of Go to and Output, are
+# zero.  Step numbers and arguments are signed 64-bit integers.  A value that does
+# not fit is replaced by zero and marked by one of the TRACE_BIG flags in the
+# opcode byte.  The records are packed into a buffer that is written to the trace
+# file whenever it fills up or, if only the last steps are kept, used as a ring
+# buffer that is written when the trace is closed.  A trace file starts with the
+# header
+#           "S2IT", format version, record size
+# and decodetrace() turns it back into the text of the --trace option.
+TRACE_MAGIC = b"S2IT"
+TRACE_VERSION = 1
+TRACE_HEADER = struct.Struct("<4sBB")
+TRACE_RECORD = struct.Struct("<Bqqq")
+TRACE_CHUNK = 4096      # the number of records written to the file at a time
+
+# Flags for values that do not fit in a record
+TRACE_BIGSTEP = 0x10
+TRACE_BIGARG1 = 0x20
+TRACE_BIGARG2 = 0x40
+TRACE_BIGFLAGS = TRACE_BIGSTEP | TRACE_BIGARG1 | TRACE_BIGARG2
+TRACE_MAXINT = 2**63 - 1
+
+# Instruction codes by the names used in trace filters
+TRACE_OPCODES = {
+    'stop':   iSTOP,
+    'goto':   iGOTO,
+    'swap':   iSWAP,
+    'output': iOUTP,
+}
+
+# Raised by TraceBuffer if the trace file cannot be written.  reason is the error
+# message of the system.
+class TraceError(Exception):
+    def __init__(self, filename, reason):
+        Exception.__init__(self, filename, reason)
+        self.filename = filename
+        self.reason = reason
+
+# Records traced steps in the open binary file stream.  Only the steps numbered
+# from steprange[0] to steprange[1] whose instruction codes are in the set
+# opcodes are recorded, if these are given, and of those only one in every sample
+# steps.  If keeplast is given, only the last keeplast records are kept and they
+# are written by close().
+class TraceBuffer(object):
+    def __init__(self, stream, steprange = None, opcodes = None, sample = 1, keeplast = None):
+        self.stream = stream
+        self.steprange = steprange
+        self.opcodes = opcodes
+        self.sample = sample
+        self.skip = 0           # steps to skip before the next sample
+        self.keeplast = keeplast
+        if keeplast:
+            self.capacity = keeplast
+        else:
+            self.capacity = TRACE_CHUNK
+        self.buffer = bytearray(self.capacity * TRACE_RECORD.size)
+        self.pos = 0            # the index of the next record in the buffer
+        self.wrapped = False    # whether the ring buffer has been filled
+        self.records = 0        # the number of records made
+        self.broken = False     # whether writing the stream has failed
+        stream.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, TRACE_RECORD.size))
+    
+    # Records the instruction instr executed at stepnum if it passes the filters.
+    def record(self, stepnum, instr):
+        if self.opcodes is not None and instr[ICODE] not in self.opcodes:
+            return
+        if self.steprange is not None and not self.steprange[0] <= stepnum <= self.steprange[1]:
+            return
+        if self.skip:
+            self.skip -= 1
+            return
+        self.skip = self.sample - 1
+        self.add(stepnum, instr)
+    
+    # Records the steps from first to last - 1 that execute() skipped as a run of
+    # do-nothing steps (see fastforward()) if they pass the filters.
+    def recordrun(self, first, last, program):
+        step = findexprstep(first, program)
+        if self.opcodes is not None and step[STEPCODE] not in self.opcodes:
+            return
+        if self.steprange is not None:
+            first = max(first, self.steprange[0])
+            last = min(last, self.steprange[1] + 1)
+        if first >= last:
+            return
+        if self.skip >= last - first:
+            self.skip -= last - first
+            return
+        first += self.skip
+        records = (last - 1 - first) // self.sample + 1
+        self.skip = self.sample - 1 - (last - 1 - first) % self.sample
+        if self.keeplast and records > self.capacity:
+            # only the last records are kept anyway
+            dropped = records - self.capacity
+            first += dropped * self.sample
+            self.records += dropped
+            self.pos = (self.pos + dropped) % self.capacity
+            self.wrapped = True
+        stepnum = first
+        while stepnum < last:
+            self.add(stepnum, evalexprstep(stepnum, step))
+            stepnum += self.sample
+    
+    # Adds a record for the instruction instr executed at stepnum to the buffer.
+    def add(self, stepnum, instr):
+        values = (stepnum, instr[ARG1] or 0, instr[ARG2] or 0)
+        try:
+            TRACE_RECORD.pack_into(self.buffer, self.pos * TRACE_RECORD.size, instr[ICODE], *values)
+        except struct.error:
+            TRACE_RECORD.pack_into(self.buffer, self.pos * TRACE_RECORD.size, *bigrecord(instr[ICODE], values))
+        self.records += 1
+        self.pos += 1
+        if self.pos == self.capacity:
+            self.pos = 0
+            if self.keeplast:
+                self.wrapped = True
+            else:
+                try:
+                    self.stream.write(self.buffer)
+                except EnvironmentError as e:
+                    self.fail(e)
+    
+    # Writes the records that are still buffered to the stream.
+    def flush(self):
+        if self.broken:
+            return
+        end = self.pos * TRACE_RECORD.size
+        try:
+            if self.wrapped:
+                self.stream.write(self.buffer[end:])
+                self.wrapped = False
+            self.stream.write(self.buffer[:end])
+            self.pos = 0
+            self.stream.flush()
+        except EnvironmentError as e:
+            self.fail(e)
+    
+    # Writes the remaining records and closes the stream.
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            try:
+                self.stream.close()
+            except EnvironmentError as e:
+                self.fail(e)
+    
+    # Raises TraceError for the error e in writing the stream, unless an earlier
+    # error has been raised already.  Nothing more is written after an error.
+    def fail(self, e):
+        if not self.broken:
+            self.broken = True
+            raise TraceError(getattr(self.stream, 'name', None), e.args[-1])
+
+# Returns the fields of a record for opcode and values, where some of the values
+# do not fit in a record.
+def bigrecord(opcode, values):
+    fields = [opcode]
+    for (value, flag) in zip(values, (TRACE_BIGSTEP, TRACE_BIGARG1, TRACE_BIGARG2)):
+        if -TRACE_MAXINT - 1 <= value <= TRACE_MAXINT:
+            fields.append(value)
+        else:
+            fields[0] |= flag
+            fields.append(0)
+    return fields
+
+# Writes the trace in the binary trace file filename to sink as the text that the
+# --trace option writes, showing values that did not fit in the trace as "?".
+# Returns False after reporting an error if the file cannot be read or is not a
+# trace file.
+def decodetrace(filename, sink):
+    try:
+        f = open(filename, 'rb')
+    except EnvironmentError as e:
+        sys.stderr.write("Error: Cannot read the trace file %s: %s\n" % (filename, e.args[-1]))
+        return False
+    try:
+        header = f.read(TRACE_HEADER.size)
+        if len(header) < TRACE_HEADER.size or TRACE_HEADER.unpack(header) != (TRACE_MAGIC, TRACE_VERSION, TRACE_RECORD.size):
+            sys.stderr.write("Error: " + filename + " is not a trace file of this version.\n")
+            return False
+        size = TRACE_RECORD.size
+        while True:
+            data = f.read(TRACE_CHUNK * size)
+            lines = []
+            for offset in xrange(0, len(data) - size + 1, size):
+                (opcode, stepnum, arg1, arg2) = TRACE_RECORD.unpack_from(data, offset)
+                if opcode & TRACE_BIGFLAGS:
+                    if opcode & TRACE_BIGSTEP:
+                        stepnum = "?"
+                    if opcode & TRACE_BIGARG1:
+                        arg1 = "?"
+                    if opcode & TRACE_BIGARG2:
+                        arg2 = "?"
+                    opcode &= ~TRACE_BIGFLAGS
+                lines.append("%s %s %s\n" % (STEP, stepnum, instr2str( (opcode, arg1, arg2) )))
+            sink.write("".join(lines))
+            if len(data) < TRACE_CHUNK * size:
+                if len(data) % size:
+                    warning("The trace file " + filename + " ends with an incomplete record.")
+                return True
+    finally:
+        f.close()
+
+# Interpreter interface
+#
+# Smetana2Infinity.py can also be imported to run programs without starting a new
+# process for each run.  loadprogram() or parseprogram() reads a program once and
+# an Interpreter runs it any number of times, for example:
+#
+#       interp = Interpreter(loadprogram("collatz1.s2i"))
+#       (step, count, stopped, outputs) = interp.run(startstep = 27)
+#
+# Every run starts from the program as it was parsed, since swaps only change the
+# swap overlay of the run that makes them.
+#
+# A run can also be made step by step from a generator.  Interpreter.slices()
+# executes the program in slices of steps and yields after each one, so that the
+# caller can do other work or give up on the run between slices.  iterrun() and
+# iterexecute() yield the output values one at a time as the run produces them,
+# running only as many slices as it takes to produce the values asked for.
 
 # Exit constants
 EXIT_OK = 0
 EXIT_TOKEN_ERR = 3
 EXIT_PARSE_ERR = 4
+EXIT_TRACE_ERR = 5
+EXIT_CHECKPOINT_ERR = 6
+EXIT_LIMIT = 7          # the run reached its step or time limit
+EXIT_SERVER_ERR = 8
+EXIT_PROFILE_ERR = 9
 
-# set up commandline argument handling
-parser = argparse.ArgumentParser(description="An interpreter for the language SMETANA To Infinity!")
-parser.add_argument("program", help="filename of the STI program to run")
-parser.add_argument("-s", "--start", help="begin execution with step N", type=int, default=1, metavar='N')
-parser.add_argument("-t", "--trace", help="trace program execution", action="store_true")
-outgrp = parser.add_argument_group("output options", "Set the behavior of the 'Output character' statement.")
-outgrp.add_argument("-a", "--ascii", help="output ASCII characters", dest='outformat', action='store_const', const=outASCII, default=outINTEGER)
-outgrp.add_argument("-i", "--integers", help="output integers (default)", dest='outformat', action='store_const', const=outINTEGER, default=outINTEGER)
-outgrp.add_argument("-u", "--unicode", help="output Unicode characters", dest='outformat', action='store_const', const=outUNICODE, default=outINTEGER)
-args = parser.parse_args()
-
-# read program file and tokenize it one line at a time
-f = open(args.program)
-try:
-    linenum = 1
-    alltokens = []
-    for line in f:
-        tokens = tokenize(line, linenum)
-        if not tokens and type(tokens) is bool:
-            sys.exit(EXIT_TOKEN_ERR)
-        # print tokens
-        # The spec does not restrict where newlines can appear so we allow
-        # steps to cross line boundaries and multiple steps per line.
-        # (This contrasts with the SMETANA grammar which requires a newline
-        #  after each step).
-        alltokens += tokens
-        linenum += 1
-finally:
-    f.close()
-
-# parse tokens and "compile" program
-program = parse(alltokens)
-if not program and type(program) is bool:
-    sys.stderr.flush()
-    sys.exit(EXIT_PARSE_ERR)
-# print program
-
-# run the program with the specified options
-execute(program, args.outformat, args.start, args.trace)
-sys.exit(EXIT_OK)
+# Execution engines by name
+ENGINES = {
+    'step':  execute,
+    'block': executeblocks,
+}
+
+# Index of the output values in the results of Interpreter.run()
+ROUTPUTS = 3
+
+# Steps in the first and the largest slices run by iterrun()
+ITER_FIRSTSLICE = 64
+ITER_MAXSLICE = 16384
+
+# Kinds of events yielded by iterrun()
+evOUTPUT = 1        # (evOUTPUT, value)
+evSTOP = 2          # (evSTOP, step#, steps executed)
+evLIMIT = 3         # (evLIMIT, step#, steps executed)
+
+# Raised by loadprogram() and parseprogram() after the error has been reported.
+# status is the exit status that the commandline interpreter uses for the error.
+class ProgramError(Exception):
+    def __init__(self, status):
+        Exception.__init__(self, status)
+        self.status = status
+
+# Reads, tokenizes and parses the program in the file filename.  If cache is true,
+# the program is read from its cache file instead if possible, and the cache file
+# is written otherwise.
+def loadprogram(filename, cache = False):
+    f = open(filename, 'rb')
+    try:
+        if not cache:
+            return parseprogram(f)
+        source = f.read()
+    finally:
+        f.close()
+    
+    digest = hashlib.sha1(source).digest()
+    cachename = filename + "c"
+    program = readcache(cachename, digest)
+    if program is None:
+        messages = []
+        program = parseprogram(source, messages)
+        writecache(cachename, digest, program, messages)
+    return program
+
+# Tokenizes and parses a program given as an open file, a string or a list of
+# lines.  Returns the program or raises ProgramError.  If messages is a list, the
+# warnings about the program are also added to it.  A string is split into lines
+# at "\n" only, exactly like a file, and not at other line breaks such as "\r".
+def parseprogram(source, messages = None):
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    elif isinstance(source, STRING_TYPES):
+        source = io.StringIO(source)
+    try:
+        program = parse([], tokenlines(source), messages)
+    except TokenError:
+        raise ProgramError(EXIT_TOKEN_ERR)
+    if not program and type(program) is bool:
+        raise ProgramError(EXIT_PARSE_ERR)
+    return program
+
+# Program cache files
+#
+# When asked to, loadprogram() keeps the parsed program in a cache file next to the
+# program file, named by adding "c" to its name (primes.s2ic for primes.s2i), and
+# reads the program from there for as long as the program file is unchanged.  A
+# cache file starts with the header
+#           "S2IC", format version, marshal version, Python version, SHA-1 digest
+# where the digest is that of the contents of the program file.  The header is
+# followed by the marshalled tuple
+#           (numbered steps, expression steps, numbered index, warnings)
+# The expression index is rebuilt when the cache file is read, and the warnings
+# that parse() printed for the program are printed again.
+CACHE_MAGIC = b"S2IC"
+CACHE_VERSION = 1
+CACHE_HEADER = struct.Struct("<4sBBBB20s")
+
+# Returns the cache file header for a program file with the SHA-1 digest digest.
+# Checkpoint files use the same header with their own magic and version.
+def cacheheader(digest, magic = CACHE_MAGIC, version = CACHE_VERSION):
+    return CACHE_HEADER.pack(magic, version, marshal.version,
+                             sys.version_info[0], sys.version_info[1], digest)
+
+# Reads the program from the cache file cachename if it was written for a program
+# file with the SHA-1 digest digest.  Returns the program or None if the cache file
+# is missing, out of date or damaged.
+def readcache(cachename, digest):
+    try:
+        f = open(cachename, 'rb')
+        try:
+            if f.read(CACHE_HEADER.size) != cacheheader(digest):
+                return None
+            data = f.read()
+        finally:
+            f.close()
+        (numberedsteps, exprsteps, numbered, messages) = marshal.loads(data)
+    except (EnvironmentError, EOFError, ValueError, TypeError):
+        return None
+    
+    for (stepnum, instr) in numberedsteps.items():
+        if instr[ICODE] == iSTOP:
+            numberedsteps[stepnum] = STOPINSTR
+    for message in messages:
+        warning(message)
+    return (numberedsteps, exprsteps, buildexprindex(exprsteps), numbered)
+
+# Writes program and the warnings about it to the cache file cachename.  A cache
+# file that cannot be written is silently skipped.
+def writecache(cachename, digest, program, messages):
+    data = marshal.dumps( (program[NUMDSTEPS], program[EXPRSTEPS], program[NUMDINDEX], messages) )
+    try:
+        writeatomic(cachename, cacheheader(digest) + data)
+    except EnvironmentError:
+        pass
+
+# Writes data to the file filename.  The file is written under a temporary name
+# first, so that no other process can read it half-written and a run that is
+# killed while writing leaves the previous file intact.
+def writeatomic(filename, data):
+    tempname = "%s.%d.tmp" % (filename, os.getpid())
+    try:
+        f = open(tempname, 'wb')
+        try:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tempname, filename)
+    except EnvironmentError:
+        try:
+            os.remove(tempname)
+        except EnvironmentError:
+            pass
+        raise
+
+# An output sink that collects the output values of a run in a list instead of
+# writing them.  Trace lines are collected in another list.
+class ListSink(object):
+    def __init__(self):
+        self.values = []
+        self.tracelines = []
+        self.output = self.values.append
+        self.write = self.tracelines.append
+    
+    # Output values are never written as text.
+    def formatall(self, values):
+        return None
+    
+    def close(self):
+        pass
+
+# Runs a parsed program with one of the execution engines.
+# If memo is true and the program has no Swap steps, its runs share a transition
+# memo (see executememo()) instead of using the engine.
+class Interpreter(object):
+    def __init__(self, program, engine = 'step', memo = False):
+        self.program = program
+        self.engine = ENGINES[engine]
+        self.memo = None
+        if memo and swapfree(program):
+            self.memo = {}
+    
+    # Runs the program from startstep, executing at most maxsteps steps if given.
+    # Returns the run result (see execute()) with the list of output values added,
+    # or with None added if the output was written to sink instead.  If trace is
+    # a TraceBuffer, the steps are recorded in it instead of traced to sink.
+    def run(self, startstep = 1, maxsteps = None, sink = None, trace = False):
+        if sink is None:
+            values = ListSink()
+            return self.run(startstep, maxsteps, values, trace)[:ROUTPUTS] + (values.values,)
+        if self.memo is not None:
+            result = execute(self.program, None, startstep, trace, sink, maxsteps, self.memo)
+        else:
+            result = self.engine(self.program, None, startstep, trace, sink, maxsteps)
+        return result + (None,)
+    
+    # Runs the program from startstep like run(), but in slices of every steps.
+    # A generator that yields the run result after each slice, with the steps
+    # executed counted from startstep and the list of values output during the
+    # slice added.  Without every, the slices start small and grow.  The run
+    # ends with the first result for which the program has stopped or reached
+    # maxsteps.
+    def slices(self, startstep = 1, maxsteps = None, every = None):
+        overlay = {}
+        cache = {}
+        curstep = startstep
+        count = 0
+        size = every or ITER_FIRSTSLICE
+        while True:
+            steps = size
+            if maxsteps is not None:
+                steps = min(steps, maxsteps - count)
+            sink = ListSink()
+            if self.memo is not None:
+                result = execute(self.program, None, curstep, False, sink, steps, self.memo)
+            else:
+                result = self.engine(self.program, None, curstep, False, sink, steps,
+                                     overlay = overlay, cache = cache)
+            curstep = result[RSTEP]
+            count += result[RCOUNT]
+            yield (curstep, count, result[RSTOPPED], sink.values)
+            if result[RSTOPPED] or count == maxsteps:
+                return
+            if every is None:
+                size = min(2 * size, ITER_MAXSLICE)
+    
+    # Runs the program from startstep in slices like slices(), but as a generator
+    # that yields a list for each slice of the output values it produced, or of
+    # its events if events is true (see iterrun()).  The event for the end of the
+    # run is added to the list of the last slice.
+    def sliceitems(self, startstep = 1, maxsteps = None, events = False, every = None):
+        for result in self.slices(startstep, maxsteps, every):
+            if not events:
+                yield result[ROUTPUTS]
+                continue
+            items = [(evOUTPUT, value) for value in result[ROUTPUTS]]
+            if result[RSTOPPED]:
+                items.append((evSTOP, result[RSTEP], result[RCOUNT]))
+            elif result[RCOUNT] == maxsteps:
+                items.append((evLIMIT, result[RSTEP], result[RCOUNT]))
+            yield items
+    
+    # Runs the program from startstep like run(), but as a generator that yields
+    # the output values as they are produced.  If events is true, it yields events
+    # instead: an (evOUTPUT, value) pair for each value and a final (evSTOP, step#,
+    # steps executed) or (evLIMIT, step#, steps executed) when the program stops or
+    # reaches maxsteps.
+    def iterrun(self, startstep = 1, maxsteps = None, events = False):
+        for items in self.sliceitems(startstep, maxsteps, events):
+            for item in items:
+                yield item
+
+# Runs program from startstep as a generator of its output values or events (see
+# Interpreter.iterrun()).
+def iterexecute(program, startstep = 1, maxsteps = None, events = False, engine = 'step'):
+    return Interpreter(program, engine).iterrun(startstep, maxsteps, events)
+
+# On Python 3.6 and later, Interpreter.aiterrun() returns an asynchronous
+# generator that yields the same values or events as iterrun() but awaits
+# asyncio.sleep(0) after each slice of steps, so that the other tasks of an event
+# loop keep running while a long program is executed.  The slices are every steps
+# long, or start small and grow without every.  Python 2 cannot parse an
+# asynchronous generator and asyncio takes a while to import, so the generator is
+# in Smetana2InfinityAsync.py, which is only imported when it is needed.
+if sys.version_info >= (3, 6):
+    def aiterrun(self, startstep = 1, maxsteps = None, events = False, every = None):
+        from Smetana2InfinityAsync import aiteritems
+        return aiteritems(self.sliceitems(startstep, maxsteps, events, every))
+    Interpreter.aiterrun = aiterrun
+    
+    # Runs program from startstep as an asynchronous generator of its output
+    # values or events (see Interpreter.aiterrun()).
+    def aiterexecute(program, startstep = 1, maxsteps = None, events = False, engine = 'step',
+                     every = None):
+        return Interpreter(program, engine).aiterrun(startstep, maxsteps, events, every)
+
+# Budgets and checkpoints
+#
+# executebudget() runs a program with one of the execution engines in slices of
+# steps, continuing each slice from the step and swap overlay where the previous
+# one ended.  Between slices it checks the time limit and saves a checkpoint of
+# the run when it is due, so the engines themselves pay nothing for either.  The
+# slices are sized to take about SLICE_TIME seconds, but never more than
+# SLICE_MAXSTEPS steps.  Only the steps executed one at a time count towards a
+# slice, since a single fast-forward can skip any number of steps in no time.
+# A checkpoint is the tuple
+#           (step#, steps executed, swap overlay, stopped, output bytes,
+#            out of range values, first out of range value, output offset)
+# where the output bytes count everything written to the output stream before the
+# checkpoint, and the output offset is where the run started writing to the
+# output file, so that output appended to a file that already held some text is
+# found again.  A checkpoint file starts with the cache file header (see
+# cacheheader()) for the program file and holds the marshalled checkpoint.
+CHECKPOINT_MAGIC = b"S2IK"
+CHECKPOINT_VERSION = 2
+CHECKPOINT_INTERVAL = 60.0  # default seconds between checkpoints
+SLICE_TIME = 0.25
+SLICE_MINSTEPS = 1024
+SLICE_MAXSTEPS = 1 << 22
+
+# Tuple indices for checkpoints
+CSTEP = 0
+CCOUNT = 1
+COVERLAY = 2
+CSTOPPED = 3
+COUTBYTES = 4
+CBADCOUNT = 5
+CFIRSTBAD = 6
+COUTBASE = 7
+
+# Returns the checkpoint of a run that has not executed any step yet and writes
+# its output from the offset outbase in the output file.
+def startcheckpoint(startstep, outbase = 0):
+    return (startstep, 0, {}, False, 0, 0, None, outbase)
+
+# Runs program from the checkpoint state with the execution engine engine (execute
+# or executeblocks) until it stops, has executed maxsteps steps in all or has run
+# for timelimit seconds.  If checkpointfile is given, a checkpoint for the program
+# file with the SHA-1 digest digest is written to it every interval seconds and
+# when the run ends.  Returns the run result, with the steps executed counted from
+# the start of the run.
+def executebudget(program, engine, state, trace, sink, maxsteps = None, timelimit = None,
+                  checkpointfile = None, digest = None, interval = CHECKPOINT_INTERVAL):
+    (curstep, count, overlay, stopped) = state[:COUTBYTES]
+    overlay = dict(overlay)
+    cache = {}
+    started = saved = time.time()
+    slicesize = SLICE_MINSTEPS
+    while not stopped and (maxsteps is None or count < maxsteps):
+        steps = None
+        if maxsteps is not None:
+            steps = maxsteps - count
+        slicestart = time.time()
+        result = engine(program, None, curstep, trace, sink, steps, overlay = overlay, cache = cache,
+                        maxexec = slicesize)
+        curstep = result[RSTEP]
+        count += result[RCOUNT]
+        stopped = result[RSTOPPED]
+        
+        now = time.time()
+        if now - slicestart < SLICE_TIME / 2 and slicesize < SLICE_MAXSTEPS:
+            slicesize *= 2
+        elif now - slicestart > SLICE_TIME * 2 and slicesize > SLICE_MINSTEPS:
+            slicesize //= 2
+        if timelimit is not None and now - started >= timelimit:
+            break
+        if checkpointfile is not None and now - saved >= interval:
+            savecheckpoint(checkpointfile, digest, (curstep, count, overlay, stopped), sink, state[COUTBASE])
+            saved = now
+    
+    if checkpointfile is not None:
+        savecheckpoint(checkpointfile, digest, (curstep, count, overlay, stopped), sink, state[COUTBASE])
+    return (curstep, count, stopped)
+
+# Raised by savecheckpoint() if the checkpoint file cannot be written.  reason
+# is the error message of the system.
+class CheckpointError(Exception):
+    def __init__(self, filename, reason):
+        Exception.__init__(self, filename, reason)
+        self.filename = filename
+        self.reason = reason
+
+# Writes the checkpoint of a run with the state (step#, steps executed, swap
+# overlay, stopped), the output written to sink so far and the output offset
+# outbase to the file filename.  The output is written first, so that the
+# checkpoint never counts output that is not in the output stream yet.
+def savecheckpoint(filename, digest, state, sink, outbase = 0):
+    sink.sync()
+    checkpoint = tuple(state) + (sink.written, sink.badcount, sink.firstbad, outbase)
+    try:
+        writeatomic(filename, cacheheader(digest, CHECKPOINT_MAGIC, CHECKPOINT_VERSION) +
+                    marshal.dumps(checkpoint))
+    except EnvironmentError as e:
+        raise CheckpointError(filename, e.args[-1])
+
+# Reads the checkpoint in the file filename, which must have been written for the
+# program file with the SHA-1 digest digest.  Returns the checkpoint, or None if
+# the file is not such a checkpoint file.
+def loadcheckpoint(filename, digest):
+    f = open(filename, 'rb')
+    try:
+        if f.read(CACHE_HEADER.size) != cacheheader(digest, CHECKPOINT_MAGIC, CHECKPOINT_VERSION):
+            return None
+        data = f.read()
+    finally:
+        f.close()
+    try:
+        checkpoint = marshal.loads(data)
+    except (EOFError, ValueError, TypeError):
+        return None
+    if type(checkpoint) is not tuple or len(checkpoint) != COUTBASE + 1:
+        return None
+    return checkpoint
+
+# Prepares sink and stream to continue the output of a run from checkpoint.  If
+# stream is a regular file holding more output than the checkpoint counts, the
+# output written after the checkpoint was saved is cut off again, so that output
+# appended to the file is the same as that of a run that was never interrupted.
+def resumeoutput(sink, stream, checkpoint):
+    sink.written = checkpoint[COUTBYTES]
+    sink.badcount = checkpoint[CBADCOUNT]
+    sink.firstbad = checkpoint[CFIRSTBAD]
+    try:
+        stream.flush()
+        info = os.fstat(stream.fileno())
+    except (AttributeError, EnvironmentError):
+        return
+    if not stat.S_ISREG(info.st_mode):
+        return
+    end = checkpoint[COUTBASE] + checkpoint[COUTBYTES]
+    if info.st_size < end:
+        warning("The output file holds less output than the checkpoint, so output was lost.")
+    elif info.st_size > end:
+        os.ftruncate(stream.fileno(), end)
+        stream.seek(end)
+
+# Returns the offset where output written to stream will start if stream is a
+# regular file, which is its end if it was opened for appending, or 0 otherwise.
+def outputoffset(stream):
+    try:
+        stream.flush()
+        fd = stream.fileno()
+        info = os.fstat(fd)
+        if not stat.S_ISREG(info.st_mode):
+            return 0
+        if fcntl is not None and fcntl.fcntl(fd, fcntl.F_GETFL) & os.O_APPEND:
+            return info.st_size
+        return os.lseek(fd, 0, os.SEEK_CUR)
+    except (AttributeError, EnvironmentError, ValueError):
+        return 0
+
+# Returns the exit status for the result of a run that was limited to maxsteps
+# steps, warning if it reached its step or time limit.
+def limitstatus(result, maxsteps):
+    if result[RSTOPPED]:
+        return EXIT_OK
+    if result[RCOUNT] == maxsteps:
+        limit = "step"
+    else:
+        limit = "time"
+    warning("The run reached its %s limit at step %d after %d steps." % (limit, result[RSTEP], result[RCOUNT]))
+    return EXIT_LIMIT
+
+# Start step sweeps
+#
+# sweep() runs a program once for every start step in a sequence, which is how
+# programs such as the Collatz examples take their input.  The runs are spread
+# across a pool of worker processes that each set up an Interpreter once.  Start
+# steps are sent to the workers in chunks to keep the cost of passing messages
+# low, and the results are returned in the order of the start steps.  A program
+# without Swap steps can also be run a whole chunk at a time by executebatch() or
+# with a transition memo that each worker shares between its runs.
+SWEEP_CHUNKSIZE = 256
+
+# The Interpreter and options of a sweep worker process
+sweepinterp = None
+sweepmaxsteps = None
+sweeplockstep = False
+
+# Initializes a sweep worker process.
+def sweepinit(program, engine, maxsteps, lockstep, memo):
+    global sweepinterp, sweepmaxsteps, sweeplockstep
+    sweepinterp = Interpreter(program, engine, memo)
+    sweepmaxsteps = maxsteps
+    sweeplockstep = lockstep
+
+# Runs the program of a sweep worker process from each step in a chunk of start steps.
+def sweeprun(startsteps):
+    return sweepchunk(sweepinterp, startsteps, sweepmaxsteps, sweeplockstep)
+
+# Runs the program of interp from each step in the list startsteps and returns
+# the list of sweep results.
+def sweepchunk(interp, startsteps, maxsteps, lockstep):
+    if lockstep:
+        results = executebatch(interp.program, startsteps, maxsteps)
+    else:
+        results = [interp.run(startstep, maxsteps) for startstep in startsteps]
+    return [(startsteps[i],) + results[i] for i in xrange(len(startsteps))]
+
+# Runs program from each step in startsteps and yields the results in the same
+# order as tuples (start step#, step#, steps executed, stopped, output values).
+# jobs is the number of worker processes, by default one per CPU.  With a single
+# job the runs are made in this process.  If lockstep is true and NumPy is
+# available, a program without Swap steps is run in batches of BATCH_SIZE start
+# steps with executebatch().  Otherwise if memo is true, a program without Swap
+# steps is run with a transition memo.
+def sweep(program, startsteps, engine = 'step', maxsteps = None, jobs = None,
+          chunksize = SWEEP_CHUNKSIZE, lockstep = False, memo = False):
+    lockstep = lockstep and havenumpy() and swapfree(program)
+    if lockstep:
+        chunksize = BATCH_SIZE
+    startsteps = iter(startsteps)
+    chunks = iter(lambda: list(itertools.islice(startsteps, chunksize)), [])
+    if jobs == 1:
+        interp = Interpreter(program, engine, memo)
+        for chunk in chunks:
+            for result in sweepchunk(interp, chunk, maxsteps, lockstep):
+                yield result
+        return
+    pool = multiprocessing.Pool(jobs, sweepinit, (program, engine, maxsteps, lockstep, memo))
+    try:
+        for results in pool.imap(sweeprun, chunks):
+            for result in results:
+                yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+# Converts a sweep result into the line written by the commandline interpreter:
+# the start step, the step where the run ended, the number of steps executed
+# (followed by "+" if the run reached the step limit before it stopped) and the
+# output values.
+def sweep2str(result):
+    (startstep, stepnum, count, stopped, outputs) = result
+    text = "%d %d %d:" % (startstep, stepnum, count)
+    if not stopped:
+        text = text[:-1] + "+:"
+    if outputs:
+        text += " " + " ".join(map(str, outputs))
+    return text
+
+# Server mode
+#
+# A server saves short runs the cost of starting the interpreter and reading and
+# parsing the program.  serve() listens on a Unix socket with a pool of worker
+# processes that all accept connections on it.  Each worker keeps the programs
+# that it has parsed in a least recently used cache of up to SERVE_CACHE_SIZE
+# programs, keyed by the SHA-1 digest of the program file and the optimizations
+# applied.  A connection carries one run, as a conversation of frames
+#           kind (1 byte), data length (4 bytes), data
+# The client sends an frREQUEST frame with a JSON object that holds the digest
+# and the options of the run.  If the program is not in its cache, the server
+# answers with frUNKNOWN and the client sends the program file in an frSOURCE
+# frame.  The server then streams the output of the run in frOUTPUT frames and
+# the messages for stderr in frERROR frames, and ends with the exit status in an
+# frEXIT frame.  Output, messages and exit status are the same as those of the
+# commandline interpreter run with the same options.
+FRAME_HEADER = struct.Struct("<cI")
+SERVE_CACHE_SIZE = 64
+SERVE_BACKLOG = 64
+SERVE_POLL = 0.5    # seconds between checks for workers that have died
+
+# Frame kinds
+frREQUEST = b'r'
+frSOURCE = b's'
+frUNKNOWN = b'u'
+frOUTPUT = b'o'
+frERROR = b'e'
+frEXIT = b'x'
+
+# Sends a frame of the given kind holding data on the socket sock.
+def sendframe(sock, kind, data):
+    sock.sendall(FRAME_HEADER.pack(kind, len(data)) + data)
+
+# Reads a frame from f, a file made from a socket.  Returns the pair (kind, data)
+# or None if the connection was closed.
+def readframe(f):
+    header = f.read(FRAME_HEADER.size)
+    if len(header) < FRAME_HEADER.size:
+        return None
+    (kind, length) = FRAME_HEADER.unpack(header)
+    data = f.read(length)
+    if len(data) < length:
+        return None
+    return (kind, data)
+
+# A stream that sends everything written to it as frames of one kind.  Text is
+# sent in UTF-8, giving back the bytes that textline() decoded.
+class FrameStream(object):
+    def __init__(self, sock, kind):
+        self.sock = sock
+        self.kind = kind
+    
+    def write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8', 'surrogateescape')
+        if data:
+            sendframe(self.sock, self.kind, data)
+    
+    def flush(self):
+        pass
+
+# Serves runs on a Unix socket at path with jobs worker processes, by default one
+# per CPU, until it is interrupted or terminated.  maxsteps, if given, limits the
+# steps of every run.  A worker that dies is replaced by a new one.
+def serve(path, jobs = None, cachesize = SERVE_CACHE_SIZE, maxsteps = None):
+    if os.path.exists(path):
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            raise socket.error(errno.EEXIST, "The path exists and is not a socket")
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except socket.error:
+            # left behind by a server that is gone
+            os.remove(path)
+        else:
+            probe.close()
+            raise socket.error(errno.EADDRINUSE, "A server is already listening on " + path)
+    
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        listener.bind(path)
+    except socket.error:
+        listener.close()
+        raise
+    try:
+        listener.listen(SERVE_BACKLOG)
+        # terminating the server shuts down the workers as well
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(EXIT_OK))
+        workers = []
+        try:
+            for i in xrange(jobs or multiprocessing.cpu_count()):
+                workers.append(startworker(listener, cachesize, maxsteps))
+            while True:
+                for i in xrange(len(workers)):
+                    if not workers[i].is_alive():
+                        workers[i].join()
+                        workers[i] = startworker(listener, cachesize, maxsteps)
+                time.sleep(SERVE_POLL)
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    os.kill(worker.pid, signal.SIGKILL)
+                    worker.join()
+    finally:
+        listener.close()
+        try:
+            os.remove(path)
+        except EnvironmentError:
+            pass
+
+# Starts a worker process that serves connections on the socket listener.
+def startworker(listener, cachesize, maxsteps):
+    worker = multiprocessing.Process(target = serveworker, args = (listener, cachesize, maxsteps))
+    worker.daemon = True
+    worker.start()
+    return worker
+
+# Accepts and serves connections on the socket listener in a worker process.
+# The workers ignore interrupts and termination, which also reach them when they
+# are sent to the process group of the server, and are killed by serve() instead.
+# No connection can end the worker, whatever goes wrong with it.
+def serveworker(listener, cachesize, maxsteps):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    cache = collections.OrderedDict()
+    while True:
+        (conn, address) = listener.accept()
+        try:
+            serveconnection(conn, cache, cachesize, maxsteps)
+        except Exception:
+            pass    # the client has gone away or the run failed
+        finally:
+            conn.close()
+
+# Serves one run on the connection conn, using and updating the program cache.
+def serveconnection(conn, cache, cachesize, maxsteps):
+    f = conn.makefile('rb')
+    frame = readframe(f)
+    if frame is None or frame[0] != frREQUEST:
+        return
+    stderr = sys.stderr
+    sys.stderr = FrameStream(conn, frERROR)
+    try:
+        status = serverequest(json.loads(frame[1]), conn, f, cache, cachesize, maxsteps)
+    except EnvironmentError:
+        raise
+    except (ValueError, KeyError, TypeError) as e:
+        sys.stderr.write("Error: Bad request: %s\n" % e)
+        status = EXIT_SERVER_ERR
+    except Exception as e:
+        sys.stderr.write("Error: The run failed on the server: %r\n" % e)
+        status = EXIT_SERVER_ERR
+    finally:
+        sys.stderr = stderr
+    sendframe(conn, frEXIT, str(status).encode('ascii'))
+
+# Runs the program of request, reading it from the client first if it is not
+# cached.  Returns the exit status.  Raises ValueError, KeyError or TypeError if
+# the request is not valid.
+def serverequest(request, conn, f, cache, cachesize, maxsteps):
+    if not isinstance(request, dict):
+        raise ValueError("the request must be an object")
+    digest = request['digest']
+    if not isinstance(digest, STRING_TYPES):
+        raise ValueError("the digest must be a string")
+    startstep = requestint(request, 'start', 1)
+    outformat = requestint(request, 'outformat', outINTEGER)
+    trace = bool(request.get('trace', False))
+    engine = ENGINES[request.get('engine', 'step')]
+    flushpolicy = FLUSHPOLICIES[request.get('flush', 'full')]
+    bufsize = requestint(request, 'bufsize', DEFAULT_BUFSIZE)
+    limit = requestint(request, 'maxsteps', None)
+    if limit is not None and limit < 1:
+        raise ValueError("maxsteps must be at least 1")
+    if maxsteps is not None and (limit is None or limit > maxsteps):
+        limit = maxsteps
+    optimized = bool(request.get('optimize', False))
+    foldgotos = optimized and not trace and limit is None
+    if outformat not in (outINTEGER, outASCII, outUNICODE, outPACKED):
+        raise ValueError("unknown output format %d" % outformat)
+    
+    key = (digest, optimized, foldgotos)
+    entry = cache.pop(key, None)
+    if entry is None:
+        sendframe(conn, frUNKNOWN, b"")
+        frame = readframe(f)
+        if frame is None or frame[0] != frSOURCE:
+            raise ValueError("expected the program")
+        if hashlib.sha1(frame[1]).hexdigest() != digest:
+            raise ValueError("the program does not match its digest")
+        warnings = []
+        try:
+            program = parseprogram(frame[1], warnings)
+        except ProgramError as e:
+            return e.status
+        notes = []
+        if optimized:
+            (program, notes) = optimize(program, foldgotos)
+        entry = (program, warnings, notes)
+    else:
+        for message in entry[1]:
+            warning(message)
+    for message in entry[2]:
+        note(message)
+    cache[key] = entry
+    while len(cache) > cachesize:
+        cache.popitem(last = False)
+    
+    sink = OutputSink(FrameStream(conn, frOUTPUT), outformat, bufsize, flushpolicy)
+    try:
+        if limit is None:
+            result = engine(entry[0], outformat, startstep, trace, sink)
+        else:
+            result = executebudget(entry[0], engine, startcheckpoint(startstep), trace, sink, limit)
+    finally:
+        sink.close()
+    return limitstatus(result, limit)
+
+# Returns the integer value of the option name in request, or default if it is
+# missing or null.  Raises ValueError if the value is not an integer.
+def requestint(request, name, default):
+    value = request.get(name)
+    if value is None:
+        return default
+    if not isinstance(value, INTEGER_TYPES) or isinstance(value, bool):
+        raise ValueError("%s must be an integer, not %r" % (name, value))
+    return value
+
+# Runs the program in the file filename on the server listening on the Unix
+# socket at path with the options in the dictionary options (see serverequest()).
+# Writes the output and messages of the run to stdout and stderr and returns its
+# exit status.
+def runremote(path, filename, options):
+    f = open(filename, 'rb')
+    try:
+        source = f.read()
+    finally:
+        f.close()
+    request = dict(options, digest = hashlib.sha1(source).hexdigest())
+    
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sendframe(sock, frREQUEST, json.dumps(request).encode('utf-8'))
+        f = sock.makefile('rb')
+        stdout = bytestream(sys.stdout)
+        stderr = bytestream(sys.stderr)
+        while True:
+            frame = readframe(f)
+            if frame is None:
+                raise socket.error(errno.ECONNRESET, "The server closed the connection")
+            (kind, data) = frame
+            if kind == frOUTPUT:
+                stdout.write(data)
+                stdout.flush()
+            elif kind == frERROR:
+                stderr.write(data)
+                stderr.flush()
+            elif kind == frUNKNOWN:
+                sendframe(sock, frSOURCE, source)
+            elif kind == frEXIT:
+                return int(data)
+    finally:
+        sock.close()
+
+# MAIN program
+
+# Flush policies selectable from the commandline
+FLUSHPOLICIES = {
+    'full':   flushFULL,
+    'line':   flushLINE,
+    'always': flushALWAYS,
+}
+
+# Runs the commandline interpreter with the arguments argv (by default the ones
+# in sys.argv) and returns the exit status.
+def main(argv = None):
+    # set up commandline argument handling
+    parser = argparse.ArgumentParser(description="An interpreter for the language SMETANA To Infinity!")
+    parser.add_argument("program", help="filename of the STI program to run", nargs='?')
+    parser.add_argument("-s", "--start", help="begin execution with step N", type=int, default=1, metavar='N')
+    parser.add_argument("-t", "--trace", help="trace program execution", action="store_true")
+    tracegrp = parser.add_argument_group("binary trace options", "Record a compact binary trace instead of the text trace.")
+    tracegrp.add_argument("--trace-file", help="record the steps executed in the binary trace file FILE", metavar='FILE')
+    tracegrp.add_argument("--trace-steps", help="record only the steps numbered from FIRST to LAST", type=int, nargs=2, metavar=('FIRST', 'LAST'))
+    tracegrp.add_argument("--trace-ops", help="record only the instructions in the comma-separated list OPS of 'stop', 'goto', 'swap' and 'output'", metavar='OPS')
+    tracegrp.add_argument("--trace-sample", help="record only one in every N steps", type=int, default=1, metavar='N')
+    tracegrp.add_argument("--trace-last", help="keep only the last K records and write them at the end", type=int, metavar='K')
+    tracegrp.add_argument("--decode-trace", help="write the binary trace file FILE as text and exit", metavar='FILE')
+    parser.add_argument("--sweep", help="run the program once for every start step from FIRST to LAST", type=int, nargs=2, metavar=('FIRST', 'LAST'))
+    parser.add_argument("-j", "--jobs", help="number of worker processes used by --sweep and --serve (default: one per CPU)", type=int, metavar='N')
+    sweepgrp = parser.add_mutually_exclusive_group()
+    sweepgrp.add_argument("--lockstep", help="run --sweep in lockstep batches using NumPy if the program has no Swap steps", action="store_true")
+    sweepgrp.add_argument("--memo", help="remember the paths taken by the runs of --sweep if the program has no Swap steps", action="store_true")
+    parser.add_argument("-O", "--optimize", help="remove expression steps that can never match and, unless steps are traced or counted, shorten chains of Go to steps; report the changes on stderr", action="store_true")
+    parser.add_argument("-c", "--cache", help="keep the parsed program in a cache file next to the program file (adding 'c' to its name) and use it while the program is unchanged", action="store_true")
+    parser.add_argument("--profile", help="count the steps, lookups and swaps executed and report them at the end", action="store_true")
+    parser.add_argument("--profile-format", help="format of the profile report: 'text' (default) or 'json'", choices=['text', 'json'], default='text')
+    parser.add_argument("--profile-output", help="write the profile report to FILE instead of stderr", metavar='FILE')
+    limitgrp = parser.add_argument_group("limit and checkpoint options", "Limit long runs and continue them later.")
+    limitgrp.add_argument("--max-steps", help="stop after executing N steps", type=int, metavar='N')
+    limitgrp.add_argument("--time-limit", help="stop after running for about SECONDS seconds", type=float, metavar='SECONDS')
+    limitgrp.add_argument("--checkpoint", help="save the state of the run in FILE from time to time and when it ends", metavar='FILE')
+    limitgrp.add_argument("--checkpoint-interval", help="seconds between checkpoints (default %g)" % CHECKPOINT_INTERVAL, type=float, metavar='SECONDS')
+    limitgrp.add_argument("--resume", help="continue the run saved in the checkpoint FILE, saving further checkpoints there unless --checkpoint is given", metavar='FILE')
+    servegrp = parser.add_argument_group("server options", "Keep parsed programs in a server and run them from clients.")
+    servemode = servegrp.add_mutually_exclusive_group()
+    servemode.add_argument("--serve", help="serve runs on the Unix socket SOCKET until interrupted, limiting them to --max-steps steps if given", metavar='SOCKET')
+    servemode.add_argument("--connect", help="run the program on the server listening on the Unix socket SOCKET", metavar='SOCKET')
+    servegrp.add_argument("--serve-cache", help="number of parsed programs kept by each server worker (default %d)" % SERVE_CACHE_SIZE, type=int, default=SERVE_CACHE_SIZE, metavar='N')
+    parser.add_argument("-e", "--engine", help="execution engine: 'step' executes one step at a time (default), 'block' compiles runs of Output and Go to steps into blocks", choices=sorted(ENGINES), default='step')
+    outgrp = parser.add_argument_group("output options", "Set the behavior of the 'Output character' statement.")
+    outgrp.add_argument("-a", "--ascii", help="output ASCII characters", dest='outformat', action='store_const', const=outASCII, default=outINTEGER)
+    outgrp.add_argument("-i", "--integers", help="output integers (default)", dest='outformat', action='store_const', const=outINTEGER, default=outINTEGER)
+    outgrp.add_argument("-u", "--unicode", help="output Unicode characters", dest='outformat', action='store_const', const=outUNICODE, default=outINTEGER)
+    outgrp.add_argument("-p", "--packed", help="output integers in a packed binary format", dest='outformat', action='store_const', const=outPACKED, default=outINTEGER)
+    bufgrp = parser.add_argument_group("buffering options", "Set how output is buffered.")
+    bufgrp.add_argument("--buffer-size", help="write output in chunks of about N bytes (default %d)" % DEFAULT_BUFSIZE, type=int, default=DEFAULT_BUFSIZE, metavar='N')
+    bufgrp.add_argument("--flush", help="when to write the buffer: when it is 'full' (default), after every 'line' or 'always' after every output", choices=['full', 'line', 'always'], default='full')
+    bufgrp.add_argument("--writer-thread", help="write output from a background thread", action="store_true")
+    args = parser.parse_args(argv)
+    # error messages show the lines of program files with their original bytes
+    if hasattr(sys.stderr, 'reconfigure'):
+        sys.stderr.reconfigure(errors = 'surrogateescape')
+    if args.decode_trace:
+        if args.program:
+            parser.error("no program file can be given with --decode-trace")
+        sink = OutputSink(sys.stdout, bufsize = args.buffer_size, flushpolicy = FLUSHPOLICIES[args.flush])
+        try:
+            if not decodetrace(args.decode_trace, sink):
+                return EXIT_TRACE_ERR
+        finally:
+            sink.close()
+        return EXIT_OK
+    if args.serve:
+        if args.program:
+            parser.error("no program file can be given with --serve")
+        if args.jobs is not None and args.jobs < 1:
+            parser.error("the number of jobs must be at least 1")
+        if args.serve_cache < 1 or (args.max_steps is not None and args.max_steps < 1):
+            parser.error("--serve-cache and --max-steps must be at least 1")
+        try:
+            serve(args.serve, args.jobs, args.serve_cache, args.max_steps)
+        except socket.error as e:
+            sys.stderr.write("Error: Cannot serve on %s: %s\n" % (args.serve, e.args[-1]))
+            return EXIT_SERVER_ERR
+        except KeyboardInterrupt:
+            pass
+        return EXIT_OK
+    if not args.program:
+        parser.error("the program file is required")
+    opcodes = None
+    if args.trace_ops:
+        try:
+            opcodes = set(TRACE_OPCODES[name.strip().lower()] for name in args.trace_ops.split(","))
+        except KeyError as e:
+            parser.error("unknown instruction '%s' in --trace-ops" % e.args[0])
+    if not args.trace_file and (args.trace_steps or opcodes or args.trace_sample != 1 or args.trace_last):
+        parser.error("--trace-steps, --trace-ops, --trace-sample and --trace-last require --trace-file")
+    if args.trace_file and args.trace:
+        parser.error("--trace cannot be used with --trace-file")
+    if args.trace_sample < 1 or (args.trace_last is not None and args.trace_last < 1):
+        parser.error("--trace-sample and --trace-last must be at least 1")
+    if args.sweep and (args.trace or args.trace_file):
+        parser.error("--trace and --trace-file cannot be used with --sweep")
+    if args.sweep and args.profile:
+        parser.error("--profile cannot be used with --sweep")
+    if args.jobs is not None and args.jobs < 1:
+        parser.error("the number of jobs must be at least 1")
+    if args.lockstep and not havenumpy():
+        parser.error("--lockstep requires NumPy")
+    checkpointfile = args.checkpoint or args.resume
+    if args.max_steps is not None and args.max_steps < 1:
+        parser.error("--max-steps must be at least 1")
+    if (args.time_limit is not None and args.time_limit <= 0) or (args.checkpoint_interval is not None and args.checkpoint_interval <= 0):
+        parser.error("--time-limit and --checkpoint-interval must be positive")
+    if args.checkpoint_interval is not None and not checkpointfile:
+        parser.error("--checkpoint-interval requires --checkpoint or --resume")
+    if (args.sweep or args.profile) and (checkpointfile or args.time_limit is not None):
+        parser.error("--time-limit, --checkpoint and --resume cannot be used with --sweep or --profile")
+    if args.connect:
+        if args.sweep or args.profile or args.trace_file or checkpointfile or args.time_limit is not None or args.cache:
+            parser.error("--connect cannot be used with --sweep, --profile, --trace-file, --checkpoint, --resume, --time-limit or --cache")
+        options = {'start': args.start, 'outformat': args.outformat, 'trace': args.trace, 'engine': args.engine,
+                   'maxsteps': args.max_steps, 'optimize': args.optimize,
+                   'bufsize': args.buffer_size, 'flush': args.flush}
+        try:
+            return runremote(args.connect, args.program, options)
+        except socket.error as e:
+            sys.stderr.write("Error: Cannot run on the server at %s: %s\n" % (args.connect, e.args[-1]))
+            return EXIT_SERVER_ERR
+
+    # read program file, tokenize it and "compile" program as it is read
+    try:
+        program = loadprogram(args.program, args.cache)
+    except ProgramError as e:
+        sys.stderr.flush()
+        return e.status
+    if args.optimize:
+        # folding Go to chains changes the steps executed, so only fold them
+        # when nothing shows those steps or counts them
+        foldgotos = not (args.trace or args.trace_file or args.sweep or args.profile or checkpointfile or
+                         args.max_steps is not None or args.time_limit is not None)
+        (program, messages) = optimize(program, foldgotos)
+        for message in messages:
+            note(message)
+    digest = None
+    checkpoint = None
+    if checkpointfile:
+        f = open(args.program, 'rb')
+        try:
+            digest = hashlib.sha1(f.read()).digest()
+        finally:
+            f.close()
+    if args.resume:
+        try:
+            checkpoint = loadcheckpoint(args.resume, digest)
+        except EnvironmentError as e:
+            sys.stderr.write("Error: Cannot read the checkpoint %s: %s\n" % (args.resume, e.args[-1]))
+            return EXIT_CHECKPOINT_ERR
+        if checkpoint is None:
+            sys.stderr.write("Error: " + args.resume + " is not a checkpoint of this program.\n")
+            return EXIT_CHECKPOINT_ERR
+    
+    # run the program with the specified options
+    profile = None
+    profilefile = None
+    status = None
+    result = None
+    if args.profile and args.profile_output:
+        # open the report file now rather than lose the profile of a long run
+        try:
+            profilefile = open(args.profile_output, 'w')
+        except EnvironmentError as e:
+            sys.stderr.write("Error: Cannot write the profile %s: %s\n" % (args.profile_output, e.args[-1]))
+            return EXIT_PROFILE_ERR
+    trace = args.trace
+    if args.trace_file:
+        try:
+            tracefile = open(args.trace_file, 'wb')
+        except EnvironmentError as e:
+            sys.stderr.write("Error: Cannot write the trace file %s: %s\n" % (args.trace_file, e.args[-1]))
+            return EXIT_TRACE_ERR
+        trace = TraceBuffer(tracefile, args.trace_steps, opcodes, args.trace_sample, args.trace_last)
+    sink = OutputSink(sys.stdout, args.outformat, args.buffer_size, FLUSHPOLICIES[args.flush], args.writer_thread)
+    try:
+        if args.sweep:
+            startsteps = xrange(args.sweep[0], args.sweep[1] + 1)
+            if args.lockstep and not swapfree(program):
+                warning("The program has Swap steps, so --lockstep is ignored.")
+            if args.memo and not swapfree(program):
+                warning("The program has Swap steps, so --memo is ignored.")
+            for runresult in sweep(program, startsteps, args.engine, args.max_steps, args.jobs,
+                                   lockstep = args.lockstep, memo = args.memo):
+                sink.write(sweep2str(runresult) + "\n")
+        elif args.profile:
+            profile = Profile(program)
+            result = executeprofile(program, args.outformat, args.start, trace, sink, args.max_steps, profile)
+        elif checkpointfile or args.max_steps is not None or args.time_limit is not None:
+            if checkpoint is None:
+                checkpoint = startcheckpoint(args.start, outputoffset(sink.stream))
+            else:
+                resumeoutput(sink, sink.stream, checkpoint)
+            try:
+                result = executebudget(program, ENGINES[args.engine], checkpoint, trace, sink,
+                                       args.max_steps, args.time_limit, checkpointfile, digest,
+                                       args.checkpoint_interval or CHECKPOINT_INTERVAL)
+            except CheckpointError as e:
+                sys.stderr.write("Error: Cannot write the checkpoint %s: %s\n" % (e.filename, e.reason))
+                return EXIT_CHECKPOINT_ERR
+        else:
+            ENGINES[args.engine](program, args.outformat, args.start, trace, sink)
+    except TraceError as e:
+        sys.stderr.write("Error: Cannot write the trace file %s: %s\n" % (e.filename, e.reason))
+        status = EXIT_TRACE_ERR
+    finally:
+        try:
+            sink.close()
+            if args.trace_file:
+                try:
+                    trace.close()
+                except TraceError as e:
+                    sys.stderr.write("Error: Cannot write the trace file %s: %s\n" % (e.filename, e.reason))
+                    status = EXIT_TRACE_ERR
+        finally:
+            # report the profile even if the program was interrupted
+            if profile is not None:
+                try:
+                    try:
+                        writeprofile(profile, args.profile_format, profilefile)
+                    finally:
+                        if profilefile is not None:
+                            profilefile.close()
+                except EnvironmentError as e:
+                    sys.stderr.write("Error: Cannot write the profile %s: %s\n" % (args.profile_output, e.args[-1]))
+                    status = EXIT_PROFILE_ERR
+    if status is not None:
+        return status
+    if result is None:
+        return EXIT_OK
+    return limitstatus(result, args.max_steps)
+
+if __name__ == '__main__':
+    sys.exit(main())
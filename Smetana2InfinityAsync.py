@@ -0,0 +1,17 @@
+# Smetana2InfinityAsync.py
+
+# The asynchronous generator behind Interpreter.aiterrun() in Smetana2Infinity.py.
+# It is kept in its own module because Python 2 cannot parse it and asyncio takes
+# a while to import, so Smetana2Infinity.py only imports it when it is needed.
+# Requires Python 3.6 or later.
+
+import asyncio
+
+# Yields the items of each list from the generator slices (see
+# Interpreter.sliceitems()) and awaits asyncio.sleep(0) after each list, so that
+# the other tasks of the event loop run between slices.
+async def aiteritems(slices):
+    for items in slices:
+        for item in items:
+            yield item
+        await asyncio.sleep(0)
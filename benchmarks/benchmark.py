@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+
+# benchmark.py
+
+# Measures the performance of Smetana2Infinity.py on generated programs and
+# compares the results with a saved baseline.
+
+# Part of the Smetana2Infinity.py distribution available from
+# https://github.com/anthonykozar/Smetana2Infinity
+
+from __future__ import print_function
+import sys
+import os
+import time
+import gc
+import json
+import random
+import platform
+import argparse
+import subprocess
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+BENCHDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHDIR))
+import Smetana2Infinity as S
+
+DEFAULT_BASELINE = os.path.join(BENCHDIR, "baseline.json")
+DEFAULT_THRESHOLD = 0.25
+DEFAULT_REPEAT = 3
+CONFIRM_RUNS = 2        # extra runs of a benchmark that seems to have regressed
+OVERLAY_SLICE = 10000   # steps between two samples of the swap overlay
+MIN_TIME = 0.01         # times shorter than this are too noisy to compare
+
+# Program generators
+#
+# Each generator takes a size parameter and returns the text of a program.
+
+# The prime sieve made by examples/MakePrimeSieve.py for primes up to size.
+# It swaps heavily and its expression steps have very large multipliers.
+def sieveprogram(size):
+    script = os.path.join(os.path.dirname(BENCHDIR), "examples", "MakePrimeSieve.py")
+    return subprocess.check_output([sys.executable, script, str(size)])
+
+# A program that outputs the numbers 1 to 50000 while matching each step against
+# size expression steps with different multipliers.
+def rulesprogram(size):
+    rng = random.Random(size)
+    lines = ["Step n. Output character n."]
+    for a in range(2, size + 2):
+        lines.append("Step %dn + %d. Output character %d." % (a, rng.randrange(a), a))
+    lines.append("Step 50001. Stop.")
+    return "\n".join(lines) + "\n"
+
+# A straight-line program of 50000 steps where a fraction size / 100 of the
+# steps swap two steps in a region after the program, so that the swap overlay
+# keeps growing.  The other steps, and those in the region, output their step
+# number.
+def swapprogram(size):
+    rng = random.Random(size)
+    length = 50000
+    lines = ["Step n + %d. Output character n." % (length + 1)]
+    for stepnum in range(1, length + 1):
+        if rng.random() * 100 < size:
+            lines.append("Step %d. Swap step %d with step %d." %
+                         (stepnum, rng.randrange(length + 2, 3 * length), rng.randrange(length + 2, 3 * length)))
+        else:
+            lines.append("Step %d. Output character %d." % (stepnum, stepnum))
+    lines.append("Step %d. Stop." % (length + 1))
+    return "\n".join(lines) + "\n"
+
+# The Collatz sequence example, which is run for the start steps 1 to size.
+def collatzprogram(size):
+    f = open(os.path.join(os.path.dirname(BENCHDIR), "examples", "collatz1.s2i"))
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+# Benchmarks as tuples (name, generator, size, number of start steps)
+BENCHMARKS = [
+    ("sieve-300",   sieveprogram,   300,    1),
+    ("sieve-1000",  sieveprogram,   1000,   1),
+    ("rules-10",    rulesprogram,   10,     1),
+    ("rules-200",   rulesprogram,   200,    1),
+    ("swaps-5",     swapprogram,    5,      1),
+    ("swaps-50",    swapprogram,    50,     1),
+    ("collatz-3000", collatzprogram, 3000,  3000),
+]
+
+# Measurements
+#
+# Each benchmark reports the time to tokenize and to parse its program, the time
+# to execute it from all of its start steps, the number of steps executed and
+# the peak size of the swap overlay during the run from the first start step.
+# All times are the best of several repetitions, measured like timeit does with
+# the garbage collector turned off.
+
+# Returns the shortest time that calling function took in repeat calls.
+def besttime(function, repeat):
+    best = None
+    gcenabled = gc.isenabled()
+    gc.disable()
+    try:
+        for i in range(repeat):
+            start = time.time()
+            function()
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+    finally:
+        if gcenabled:
+            gc.enable()
+    return best
+
+# Parses a list of token lists without printing warnings.
+def quietparse(tokens):
+    stderr = sys.stderr
+    sys.stderr = StringIO()
+    try:
+        return S.parse([], iter(tokens))
+    finally:
+        sys.stderr = stderr
+
+# Executes program from each of the start steps and returns the total number of
+# steps executed.
+def executeall(program, startsteps, sink):
+    count = 0
+    for startstep in startsteps:
+        count += S.execute(program, None, startstep, False, sink)[S.RCOUNT]
+    return count
+
+# Executes program from startstep in slices of OVERLAY_SLICE steps and returns
+# the largest number of entries and bytes used by the swap overlay.  PyPy cannot
+# measure the bytes, which are reported as 0 there.
+def overlaypeak(program, startstep, sink):
+    overlay = {}
+    peakentries = peakbytes = 0
+    while True:
+        result = S.execute(program, None, startstep, False, sink, OVERLAY_SLICE, None, overlay)
+        peakentries = max(peakentries, len(overlay))
+        peakbytes = max(peakbytes, sys.getsizeof(overlay, 0))
+        if result[S.RSTOPPED]:
+            return (peakentries, peakbytes)
+        startstep = result[S.RSTEP]
+
+# Runs one benchmark and returns its results as a dictionary.
+def runbenchmark(generator, size, nstarts, repeat):
+    lines = generator(size).splitlines(True)
+    tokens = list(S.tokenlines(lines))
+    program = quietparse(tokens)
+    startsteps = range(1, nstarts + 1)
+    devnull = open(os.devnull, "w")
+    sink = S.OutputSink(devnull)
+    try:
+        results = {}
+        results["tokenize_s"] = besttime(lambda: list(S.tokenlines(lines)), repeat)
+        results["parse_s"] = besttime(lambda: quietparse(tokens), repeat)
+        results["steps"] = executeall(program, startsteps, sink)
+        results["execute_s"] = besttime(lambda: executeall(program, startsteps, sink), repeat)
+        results["steps_per_s"] = results["steps"] / max(results["execute_s"], 1e-9)
+        (results["overlay_peak_entries"], results["overlay_peak_bytes"]) = overlaypeak(program, 1, sink)
+    finally:
+        sink.close()
+        devnull.close()
+    return results
+
+# Comparison with the baseline
+#
+# For each metric, the kind of change that counts as a regression
+LOWER_IS_BETTER = ["tokenize_s", "parse_s", "execute_s", "overlay_peak_bytes"]
+HIGHER_IS_BETTER = ["steps_per_s"]
+MUST_MATCH = ["steps"]
+
+# Compares the results of one benchmark with its baseline and returns a list of
+# messages describing the regressions.
+def regressions(name, results, baseline, threshold):
+    messages = []
+    for metric in MUST_MATCH:
+        if metric in baseline and results[metric] != baseline[metric]:
+            messages.append("%s: %s changed from %s to %s" % (name, metric, baseline[metric], results[metric]))
+    for metric in LOWER_IS_BETTER:
+        if metric not in baseline or (metric.endswith("_s") and baseline[metric] < MIN_TIME):
+            continue
+        if results[metric] > baseline[metric] * (1 + threshold):
+            messages.append("%s: %s rose from %.4g to %.4g" % (name, metric, baseline[metric], results[metric]))
+    for metric in HIGHER_IS_BETTER:
+        if metric not in baseline or baseline.get("execute_s", 0) < MIN_TIME:
+            continue
+        if results[metric] < baseline[metric] / (1 + threshold):
+            messages.append("%s: %s fell from %.4g to %.4g" % (name, metric, baseline[metric], results[metric]))
+    return messages
+
+# Combines the results of two runs of a benchmark by keeping the best value of
+# each metric.
+def bestresults(results, other):
+    best = dict(results)
+    for metric in LOWER_IS_BETTER:
+        best[metric] = min(results[metric], other[metric])
+    for metric in HIGHER_IS_BETTER:
+        best[metric] = max(results[metric], other[metric])
+    return best
+
+# MAIN program
+
+parser = argparse.ArgumentParser(description="Benchmarks for Smetana2Infinity.py")
+parser.add_argument("names", help="benchmarks to run (default: all)", nargs='*', metavar='NAME')
+parser.add_argument("-b", "--baseline", help="baseline file (default: baseline.json next to this script)", default=DEFAULT_BASELINE, metavar='FILE')
+parser.add_argument("--save", help="save the results as the new baseline instead of comparing them", action="store_true")
+parser.add_argument("--threshold", help="relative change that counts as a regression (default %g)" % DEFAULT_THRESHOLD, type=float, default=DEFAULT_THRESHOLD)
+parser.add_argument("-r", "--repeat", help="repetitions of each measurement (default %d)" % DEFAULT_REPEAT, type=int, default=DEFAULT_REPEAT, metavar='N')
+parser.add_argument("-l", "--list", help="list the benchmarks and exit", action="store_true")
+args = parser.parse_args()
+
+if args.list:
+    for (name, generator, size, nstarts) in BENCHMARKS:
+        print(name)
+    sys.exit(0)
+known = [benchmark[0] for benchmark in BENCHMARKS]
+for name in args.names:
+    if name not in known:
+        parser.error("unknown benchmark '%s'" % name)
+
+baseline = {}
+if os.path.exists(args.baseline):
+    f = open(args.baseline)
+    try:
+        baseline = json.load(f).get("benchmarks", {})
+    finally:
+        f.close()
+
+print("%-14s %10s %10s %10s %12s %12s %10s" % ("benchmark", "tokenize", "parse", "execute", "steps", "steps/s", "overlay"))
+allresults = {}
+messages = []
+for (name, generator, size, nstarts) in BENCHMARKS:
+    if args.names and name not in args.names:
+        continue
+    results = runbenchmark(generator, size, nstarts, args.repeat)
+    if not args.save and name in baseline:
+        # measure again before reporting a regression, which may just be noise
+        for i in range(CONFIRM_RUNS):
+            if not regressions(name, results, baseline[name], args.threshold):
+                break
+            results = bestresults(results, runbenchmark(generator, size, nstarts, args.repeat))
+    allresults[name] = results
+    print("%-14s %9.3fs %9.3fs %9.3fs %12d %12.0f %9dB" % (name, results["tokenize_s"], results["parse_s"],
+        results["execute_s"], results["steps"], results["steps_per_s"], results["overlay_peak_bytes"]))
+    sys.stdout.flush()
+    if not args.save and name in baseline:
+        messages += regressions(name, results, baseline[name], args.threshold)
+
+if args.save:
+    # keep the baselines of the benchmarks that were not run
+    baseline.update(allresults)
+    f = open(args.baseline, "w")
+    try:
+        json.dump({"python": platform.python_version(), "platform": platform.platform(),
+                   "benchmarks": baseline}, f, indent = 1, sort_keys = True, separators = (",", ": "))
+        f.write("\n")
+    finally:
+        f.close()
+    print("Saved the results to", args.baseline)
+elif messages:
+    print()
+    print("Regressions beyond %d%%:" % round(args.threshold * 100))
+    for message in messages:
+        print("  " + message)
+    sys.exit(1)
@@ -0,0 +1,231 @@
+#!/bin/sh
+
+# Checks that the execution modes of the interpreter give the same output as a
+# plain run.  Run from the tests directory, optionally with the Python to use:
+#	./test-modes.sh [python]
+
+PYTHON=${1:-python}
+S2I=../Smetana2Infinity.py
+TMP=${TMPDIR:-/tmp}/s2i-test-$$
+mkdir -p "$TMP"
+trap 'rm -rf "$TMP"' EXIT
+failures=0
+
+# check NAME FILE1 FILE2: reports whether the two files are the same
+check() {
+	if cmp -s "$2" "$3" ; then
+		echo "ok    $1"
+	else
+		echo "FAIL  $1"
+		failures=$((failures + 1))
+	fi
+}
+
+# Resuming a checkpointed run appends exactly the rest of the output, even to
+# a file that held other text before the run and output written after the
+# checkpoint was saved.
+echo "header line" > "$TMP/expected"
+$PYTHON $S2I ../examples/primes.s2i >> "$TMP/expected"
+echo "header line" > "$TMP/output"
+$PYTHON $S2I --max-steps 1000 --checkpoint "$TMP/run.chk" ../examples/primes.s2i >> "$TMP/output" 2> /dev/null
+echo "written after the checkpoint" >> "$TMP/output"
+$PYTHON $S2I --max-steps 2000 --resume "$TMP/run.chk" ../examples/primes.s2i >> "$TMP/output" 2> /dev/null
+$PYTHON $S2I --resume "$TMP/run.chk" ../examples/primes.s2i >> "$TMP/output"
+check "resume" "$TMP/expected" "$TMP/output"
+
+# A checkpoint file that cannot be read or written ends the run with exit
+# status 6.
+$PYTHON $S2I --resume "$TMP/missing.chk" ../examples/primes.s2i > /dev/null 2>&1
+echo "exit status $?" > "$TMP/output"
+$PYTHON $S2I --max-steps 100 --checkpoint "$TMP/missing/run.chk" ../examples/primes.s2i > /dev/null 2>&1
+echo "exit status $?" >> "$TMP/output"
+printf 'exit status 6\nexit status 6\n' > "$TMP/expected"
+check "checkpoint errors" "$TMP/expected" "$TMP/output"
+
+# --time-limit ends a run in time even after it has fast-forwarded over many
+# steps.  The program skips almost 10^15 steps and then loops for ever.  A run
+# that is still going after 10 seconds is killed.
+cat > "$TMP/long-runs.s2i" <<EOF
+Step n. Go to step n + 1.
+Step 1. Go to step 2.
+Step 1000000000000000. Output character 1.
+Step 1000000000000001. Go to step 1000000000000000.
+EOF
+for engine in step block ; do
+	$PYTHON $S2I -e $engine --time-limit 1 "$TMP/long-runs.s2i" > /dev/null 2>&1 &
+	run=$!
+	( sleep 10 ; kill $run ) > /dev/null 2>&1 &
+	wait $run 2> /dev/null
+	echo "exit status $?" > "$TMP/output"
+	echo "exit status 7" > "$TMP/expected"
+	check "time limit -e $engine" "$TMP/expected" "$TMP/output"
+done
+
+# The block engine gives the same output and trace as the default engine for
+# programs that swap steps inside their blocks.
+for f in swap-blocks.s2i replaced-steps.s2i ../examples/primes.s2i ../examples/sample.s2i ; do
+	$PYTHON $S2I -t "$f" > "$TMP/expected" 2>&1
+	$PYTHON $S2I -t -e block "$f" > "$TMP/output" 2>&1
+	check "block engine $f" "$TMP/expected" "$TMP/output"
+done
+
+# With --flush always, each value is written as soon as it is output, even by
+# a program that then loops for ever.
+cat > "$TMP/loop.s2i" <<EOF
+Step 1. Output character 97.
+Step 2. Output character 98.
+Step 3. Go to step 3.
+EOF
+printf 'ab' > "$TMP/expected"
+for engine in step block ; do
+	$PYTHON $S2I -a --flush always -e $engine "$TMP/loop.s2i" > "$TMP/output" 2> /dev/null &
+	run=$!
+	sleep 2
+	kill $run 2> /dev/null
+	wait $run 2> /dev/null
+	check "flush always -e $engine" "$TMP/expected" "$TMP/output"
+done
+
+# An output sink writes the same text to a text stream without a binary stream,
+# such as io.StringIO, as it writes in UTF-8 to a file.
+for f in unicode-test.s2i ../examples/hello.s2i ; do
+	$PYTHON $S2I -u "$f" > "$TMP/expected" 2> /dev/null
+	$PYTHON -c '
+import io, sys
+sys.path.insert(0, "..")
+from Smetana2Infinity import *
+text = io.StringIO()
+sink = OutputSink(text, outUNICODE)
+execute(loadprogram(sys.argv[1]), outUNICODE, 1, False, sink)
+sink.close()
+bytestream(sys.stdout).write(text.getvalue().encode("utf-8"))
+' "$f" > "$TMP/output" 2> /dev/null
+	check "text stream sink $f" "$TMP/expected" "$TMP/output"
+done
+
+# A program read through its cache file, both when the cache file is written
+# and when it is read, runs exactly like the program file itself.
+for f in bad-comment-cr.s2i warnings.s2i ../examples/primes.s2i ; do
+	cp "$f" "$TMP/cached.s2i"
+	rm -f "$TMP/cached.s2ic"
+	$PYTHON $S2I -a "$TMP/cached.s2i" > "$TMP/expected" 2>&1
+	echo "exit status $?" >> "$TMP/expected"
+	for run in write read ; do
+		$PYTHON $S2I -a -c "$TMP/cached.s2i" > "$TMP/output" 2>&1
+		echo "exit status $?" >> "$TMP/output"
+		check "cached parsing ($run) $f" "$TMP/expected" "$TMP/output"
+	done
+done
+
+# Sweeps give the same results with any number of jobs, with --memo, with
+# --lockstep (if NumPy is installed) and with the block engine, also for runs
+# that reach the step limit.
+modes="-j3 --memo -eblock"
+if $PYTHON -c "import numpy" 2> /dev/null ; then
+	modes="$modes --lockstep"
+fi
+for run in ../examples/collatz1.s2i "--max-steps 50 ../examples/collatz1.s2i" "--max-steps 50 ../examples/sample.s2i" ; do
+	$PYTHON $S2I -j 1 --sweep 1 100 $run > "$TMP/expected" 2> /dev/null
+	for mode in $modes ; do
+		$PYTHON $S2I $mode --sweep 1 100 $run > "$TMP/output" 2> /dev/null
+		check "sweep $mode $run" "$TMP/expected" "$TMP/output"
+	done
+done
+
+# Optimizing or profiling a program does not change what it does: -O and
+# --profile runs give the same output, warnings and exit status as plain runs.
+# With --max-steps, -O leaves the Go to chains alone and must stop at the same
+# step.  The notes of -O about its changes are left out of the comparison.  The
+# generated program has Go to chains that take 1200 steps, or 800 when folded.
+i=0
+while [ $i -lt 400 ] ; do
+	echo "Step $((3 * i + 1)). Go to step $((3 * i + 2))."
+	echo "Step $((3 * i + 2)). Go to step $((3 * i + 3))."
+	echo "Step $((3 * i + 3)). Output character 1."
+	i=$((i + 1))
+done > "$TMP/goto-chains.s2i"
+echo "Step 1201. Stop." >> "$TMP/goto-chains.s2i"
+for f in *.s2i ../examples/*.s2i "$TMP/goto-chains.s2i" ; do
+	for limit in "" "--max-steps 1000" ; do
+		$PYTHON $S2I -a $limit "$f" > "$TMP/expected" 2>&1
+		echo "exit status $?" >> "$TMP/expected"
+		$PYTHON $S2I -a -O $limit "$f" > "$TMP/optimized" 2>&1
+		echo "exit status $?" >> "$TMP/optimized"
+		grep -a -v "^Note: " "$TMP/optimized" > "$TMP/output"
+		check "optimize $limit $f" "$TMP/expected" "$TMP/output"
+	done
+	$PYTHON $S2I -a --max-steps 1000 "$f" > "$TMP/expected" 2>&1
+	echo "exit status $?" >> "$TMP/expected"
+	$PYTHON $S2I -a --max-steps 1000 --profile --profile-output "$TMP/profile.txt" "$f" > "$TMP/output" 2>&1
+	echo "exit status $?" >> "$TMP/output"
+	check "profile $f" "$TMP/expected" "$TMP/output"
+done
+
+# A profile report that cannot be written ends the run with exit status 9.
+$PYTHON $S2I --profile --profile-output "$TMP/missing/profile.txt" ../examples/hello.s2i > /dev/null 2>&1
+echo "exit status $?" > "$TMP/output"
+echo "exit status 9" > "$TMP/expected"
+check "profile errors" "$TMP/expected" "$TMP/output"
+
+# A trace file decodes to the same steps as --trace writes.
+for f in swap-blocks.s2i replaced-steps.s2i ../examples/primes.s2i ../examples/sample.s2i ; do
+	$PYTHON $S2I -t "$f" 2> /dev/null | grep "^Step " > "$TMP/expected"
+	$PYTHON $S2I --trace-file "$TMP/run.trace" "$f" > /dev/null 2>&1
+	$PYTHON $S2I --decode-trace "$TMP/run.trace" > "$TMP/output"
+	check "trace file $f" "$TMP/expected" "$TMP/output"
+done
+
+# A trace file that cannot be written or read ends the run with exit status 5.
+$PYTHON $S2I --trace-file "$TMP/missing/trace.bin" ../examples/hello.s2i > /dev/null 2>&1
+echo "exit status $?" > "$TMP/output"
+$PYTHON $S2I --decode-trace "$TMP/missing/trace.bin" > /dev/null 2>&1
+echo "exit status $?" >> "$TMP/output"
+echo "exit status 5" > "$TMP/expected"
+echo "exit status 5" >> "$TMP/expected"
+check "trace file errors" "$TMP/expected" "$TMP/output"
+
+# Runs on a server give the same output, messages and exit status as plain
+# runs, both when the server reads the program and when it has it cached.  The
+# server has a single worker, which must survive a request that it cannot run.
+$PYTHON $S2I -j 1 --serve "$TMP/s2i.sock" 2> /dev/null &
+server=$!
+tries=0
+while [ ! -S "$TMP/s2i.sock" ] && [ $tries -lt 100 ] ; do
+	sleep 0.1
+	tries=$((tries + 1))
+done
+for f in bad-comment-cr.s2i warnings.s2i swap-blocks.s2i ../examples/primes.s2i ../examples/sample.s2i ; do
+	$PYTHON $S2I -a "$f" > "$TMP/expected" 2>&1
+	echo "exit status $?" >> "$TMP/expected"
+	for run in first cached ; do
+		$PYTHON $S2I -a --connect "$TMP/s2i.sock" "$f" > "$TMP/output" 2>&1
+		echo "exit status $?" >> "$TMP/output"
+		check "server ($run) $f" "$TMP/expected" "$TMP/output"
+	done
+done
+$PYTHON -c '
+import json, socket, sys
+sys.path.insert(0, "..")
+from Smetana2Infinity import *
+sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+sock.connect(sys.argv[1])
+sendframe(sock, frREQUEST, b"{\"digest\": \"0\", \"start\": Infinity}")
+f = sock.makefile("rb")
+frame = readframe(f)
+while frame is not None and frame[0] != frEXIT:
+	frame = readframe(f)
+print("exit status %s" % frame[1].decode("ascii"))
+' "$TMP/s2i.sock" > "$TMP/output" 2>&1
+$PYTHON $S2I --connect "$TMP/s2i.sock" ../examples/hello.s2i >> "$TMP/output" 2>&1
+echo "exit status $?" >> "$TMP/output"
+echo "exit status 8" > "$TMP/expected"
+$PYTHON $S2I ../examples/hello.s2i >> "$TMP/expected" 2>&1
+echo "exit status $?" >> "$TMP/expected"
+check "server after a bad request" "$TMP/expected" "$TMP/output"
+kill $server
+wait $server
+
+if [ $failures -ne 0 ] ; then
+	echo "$failures checks failed"
+	exit 1
+fi